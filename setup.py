@@ -42,6 +42,9 @@ the features are the minimum I need for my own needs. You've been warned!
     version="0.1",
     url="http://github.com/iskandr/striate",
     packages=[ 'striate' ],
+    entry_points={
+      'console_scripts' : [ 'striate = striate.bench:main' ],
+    },
     package_dir={ 
       'striate' : 'striate',
       'cudaconv2' : 'cudaconv2' ,
@@ -6,6 +6,7 @@ import os
 import random as r
 import numpy.random as nr
 import pylab as pl
+from striate.checkpoint import load as load_checkpoint
 import striate.util as util
 import matplotlib.pyplot as plt
 
@@ -18,7 +19,7 @@ class ShowNetError(Exception):
 class ShowConvNet:
   def __init__(self, checkpoint, show_filters, channels = 3):
     self.checkpoint = checkpoint
-    self.model = util.load(self.checkpoint)
+    self.model = load_checkpoint(self.checkpoint)
     self.layers = self.model['model_state']['layers']
     self.show_filters = show_filters
     self.channels = channels
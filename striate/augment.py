@@ -0,0 +1,162 @@
+'''Batch level data augmentation.
+
+A Pipeline runs a list of stages over a whole (n, 3, rows, cols) batch of
+pixel values in [0, 255], uint8 or float32.  Stages that keep the shape of
+the batch modify it in place; crop returns a new, smaller batch.  Every
+batch gets its own random generator seeded from (seed, epoch, batchnum), so
+the same batch is augmented the same way whichever thread or process loads
+it.
+
+Pipelines are written as a comma separated list of stages, each with its
+arguments after colons, e.g.
+
+  crop:224,flip,lighting:0.1,brightness:0.2,contrast:0.2
+'''
+
+from numpy.lib.stride_tricks import as_strided
+from striate import util
+import numpy as np
+import random
+import threading
+import time
+
+def crop(images, ys, xs, size, index=None):
+  '''Return the size x size square at (ys[i], xs[i]) of image index[i] (of
+  image i if index is None) of a (n, 3, rows, cols) batch, for every i.
+
+  All crops are gathered at once from a strided view holding every possible
+  window, so there is no per-image Python loop.'''
+  n, channels, rows, cols = images.shape
+  if index is None:
+    index = np.arange(n)
+  s = images.strides
+  windows = as_strided(images,
+                       shape=(n, channels, rows - size + 1, cols - size + 1, size, size),
+                       strides=(s[0], s[1], s[2], s[3], s[2], s[3]))
+  return windows[index, :, ys, xs]
+
+
+def _store(images, values):
+  '''Write float values back into images, clipped to the pixel range.'''
+  np.clip(values, 0, 255, out=values)
+  if images.dtype == np.uint8:
+    np.rint(values, out=values)
+  images[...] = values
+  return images
+
+
+class Crop(object):
+  name = 'crop'
+  def __init__(self, size):
+    self.size = int(size)
+
+  def __call__(self, images, rng):
+    n, _, rows, cols = images.shape
+    ys = rng.randint(0, rows - self.size + 1, size=n)
+    xs = rng.randint(0, cols - self.size + 1, size=n)
+    return crop(images, ys, xs, self.size)
+
+
+class Flip(object):
+  '''Mirror every image left to right with probability 1/2.'''
+  name = 'flip'
+  def __call__(self, images, rng):
+    flips = rng.randint(2, size=len(images)) == 0
+    images[flips] = images[flips, :, :, ::-1]
+    return images
+
+
+class Lighting(object):
+  '''Shift the colour of every image along the principal components of the
+  ImageNet pixel colours, by random amounts of standard deviation std.'''
+  name = 'lighting'
+  EIGVAL = np.array([0.2175, 0.0188, 0.0045], dtype=np.single) * 255
+  EIGVEC = np.array([[-0.5675, 0.7192, 0.4009],
+                     [-0.5808, -0.0045, -0.8140],
+                     [-0.5836, -0.6948, 0.4203]], dtype=np.single)
+
+  def __init__(self, std=0.1):
+    self.std = float(std)
+
+  def __call__(self, images, rng):
+    alpha = rng.normal(0, self.std, size=(len(images), 3)).astype(np.single)
+    shift = np.dot(alpha * Lighting.EIGVAL, Lighting.EIGVEC.T)
+    values = images.astype(np.single)
+    values += shift[:, :, np.newaxis, np.newaxis]
+    return _store(images, values)
+
+
+class Brightness(object):
+  '''Scale every image by a random factor in [1 - delta, 1 + delta].'''
+  name = 'brightness'
+  def __init__(self, delta=0.2):
+    self.delta = float(delta)
+
+  def __call__(self, images, rng):
+    factor = rng.uniform(1 - self.delta, 1 + self.delta, size=len(images)).astype(np.single)
+    values = images.astype(np.single)
+    values *= factor[:, np.newaxis, np.newaxis, np.newaxis]
+    return _store(images, values)
+
+
+class Contrast(object):
+  '''Scale the distance of every pixel from its image's mean by a random
+  factor in [1 - delta, 1 + delta].'''
+  name = 'contrast'
+  def __init__(self, delta=0.2):
+    self.delta = float(delta)
+
+  def __call__(self, images, rng):
+    factor = rng.uniform(1 - self.delta, 1 + self.delta, size=len(images)).astype(np.single)
+    factor = factor[:, np.newaxis, np.newaxis, np.newaxis]
+    values = images.astype(np.single)
+    mean = values.reshape((len(images), -1)).mean(axis=1)[:, np.newaxis, np.newaxis, np.newaxis]
+    values -= mean
+    values *= factor
+    values += mean
+    return _store(images, values)
+
+
+STAGES = dict((stage.name, stage) for stage in [Crop, Flip, Lighting, Brightness, Contrast])
+
+class Pipeline(object):
+  def __init__(self, stages, seed=None):
+    self.stages = stages
+    self.seed = random.randint(0, 2 ** 31 - 1) if seed is None else seed
+    self.times = dict((stage.name, 0.0) for stage in stages)
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def parse(spec, seed=None):
+    stages = []
+    for item in spec.split(','):
+      fields = item.strip().split(':')
+      if fields[0] not in STAGES:
+        raise ValueError('Unknown augmentation stage %s, expected one of %s' % (fields[0], sorted(STAGES)))
+      stages.append(STAGES[fields[0]](*fields[1:]))
+    return Pipeline(stages, seed)
+
+  def __call__(self, images, epoch, batchnum):
+    rng = np.random.RandomState(hash((self.seed, epoch, batchnum)) % 2 ** 32)
+    for stage in self.stages:
+      start = time.time()
+      images = stage(images, rng)
+      with self._lock:
+        self.times[stage.name] += time.time() - start
+    return images
+
+  def output_shape(self, image_shape):
+    '''The shape the stages turn image_shape images into, found by running
+    them over one blank image; None if they cannot take such images.'''
+    images = np.zeros((1,) + tuple(image_shape), dtype=np.single)
+    rng = np.random.RandomState(0)
+    try:
+      for stage in self.stages:
+        images = stage(images, rng)
+    except ValueError:
+      return None
+    return images.shape[1:]
+
+  def log_times(self):
+    util.log('Augmentation time: %s',
+             ', '.join('%s %.2fs' % (stage.name, self.times[stage.name]) for stage in self.stages))
@@ -0,0 +1,125 @@
+'''Time a data provider on its own, without a network to feed.
+
+Takes the data arguments of trainer.py, pulls --num_batches batches and
+reports images per second, the time spent in each loading stage and the
+median and 99th percentile per-batch latency, e.g.
+
+  striate --data_dir /ssd/nn-data/imagenet/ --data_provider imagenet \
+      --train_range 0-1299 --num_batches 50 --num_workers 0,4,8
+
+Several --num_workers values run one after the other, so the sweep shows
+where decoding stops scaling.
+'''
+
+from striate import util
+from striate.data import DataProvider, ImageNetDataProvider, dp_dict
+import argparse
+import numpy as np
+import sys
+import time
+
+# in the order a batch goes through them
+STAGES = ['read', 'cache', 'decode', 'convert', 'crop', 'mean']
+
+def run(dp_class, data_dir, batch_range, num_batches, warmup=2, **dp_params):
+  '''Load warmup + num_batches batches and return the measurements of the
+  last num_batches.'''
+  dp = dp_class(data_dir, batch_range, **dp_params)
+  try:
+    for i in range(warmup):
+      dp.get_next_batch()
+    with dp._timing_lock:
+      dp.timings.clear()
+      dp.load_times.clear()
+
+    waits = []
+    num_images = 0
+    start = time.time()
+    for i in range(num_batches):
+      st = time.time()
+      batch = dp.get_next_batch()
+      waits.append(time.time() - st)
+      num_images += dp.get_num_cases(batch)
+    elapsed = time.time() - start
+  finally:
+    dp.close()
+
+  with dp._timing_lock:
+    return {'elapsed': elapsed,
+            'images': num_images,
+            'timings': dict(dp.timings),
+            'waits': np.array(waits),
+            'loads': np.array(dp.load_times)}
+
+
+def report(result, batch_size, label=''):
+  elapsed = result['elapsed']
+  num_batches = len(result['waits'])
+  print >> sys.stderr, '---- %s' % label
+  print >> sys.stderr, '%d images in %.2f s: %.1f images/s, %.1f minibatches of %d/s' % (
+      result['images'], elapsed, result['images'] / elapsed,
+      result['images'] / float(batch_size) / elapsed, batch_size)
+
+  # summed over reader threads and decode workers, so they can add up to
+  # more than the wall clock time
+  timings = result['timings']
+  for name in STAGES + sorted(set(timings) - set(STAGES)):
+    if name in timings:
+      print >> sys.stderr, '  %-8s %8.3f s  %7.2f ms/batch' % (name, timings[name], 1000 * timings[name] / num_batches)
+  print >> sys.stderr, '  %-8s %8.3f s  %7.2f ms/batch' % ('wait', result['waits'].sum(), 1000 * result['waits'].mean())
+
+  for name, values in [('wait', result['waits']), ('load', result['loads'])]:
+    if len(values):
+      print >> sys.stderr, '  %s latency p50 %.2f ms, p99 %.2f ms' % (
+          name, 1000 * np.percentile(values, 50), 1000 * np.percentile(values, 99))
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmark a data provider')
+  parser.add_argument('--data_dir', help = 'The directory of the data', required = True)
+  parser.add_argument('--data_provider', help = 'The data provider', choices = sorted(dp_dict), required = True)
+  parser.add_argument('--train_range', help = 'The batch range to read', default = None)
+  parser.add_argument('--batch_size', help = 'The minibatch size the trainer would use', default = 128, type = int)
+  parser.add_argument('--num_batches', help = 'How many batches to time', default = 20, type = int)
+  parser.add_argument('--warmup', help = 'How many batches to load before timing', default = 2, type = int)
+  parser.add_argument('--num_workers', help = 'Comma separated JPEG decode worker counts to try', default = '0')
+  parser.add_argument('--prefetch', help = 'How many batches to load ahead on top of one per reader', default = 1, type = int)
+  parser.add_argument('--num_readers', help = 'How many batches to load at once', default = 1, type = int)
+  parser.add_argument('--readahead', help = 'MB of upcoming batch files to read ahead', default = 0, type = int)
+  parser.add_argument('--raw_pixels', help = 'Queue uint8 batches', default = 0, type = int)
+  parser.add_argument('--sample_major', help = 'Assemble batches with one image per row', default = 0, type = int)
+  parser.add_argument('--augment', help = 'Augmentation stages, e.g. crop:224,flip', default = '')
+  args = parser.parse_args(argv)
+
+  dp_class = DataProvider.get_by_name(args.data_provider)
+  batch_range = util.string_to_int_list(args.train_range) if args.train_range else None
+
+  dp_params = {}
+  if args.prefetch != 1:
+    dp_params['prefetch'] = args.prefetch
+  if args.num_readers != 1:
+    dp_params['num_readers'] = args.num_readers
+  if args.readahead:
+    dp_params['readahead'] = args.readahead * 2 ** 20
+  if args.raw_pixels:
+    dp_params['raw_pixels'] = True
+  if args.sample_major:
+    dp_params['sample_major'] = True
+  if args.augment:
+    dp_params['augment'] = args.augment
+
+  worker_counts = [int(n) for n in args.num_workers.split(',')]
+  decodes_jpegs = issubclass(dp_class, ImageNetDataProvider) and dp_class.decodes_jpegs
+  if any(worker_counts) and not decodes_jpegs:
+    parser.error('--num_workers only applies to providers that decode JPEGs, not %s' % args.data_provider)
+
+  for num_workers in worker_counts:
+    params = dict(dp_params)
+    if num_workers:
+      params['num_workers'] = num_workers
+    result = run(dp_class, args.data_dir, batch_range, args.num_batches, args.warmup, **params)
+    report(result, args.batch_size, '%s, %d decode workers' % (args.data_provider, num_workers))
+
+
+if __name__ == '__main__':
+  main()
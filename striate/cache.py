@@ -0,0 +1,114 @@
+'''A two level cache of decoded images, keyed by image index.
+
+The first level is a block of RAM, the second an optional file on a local
+disk; both hold fixed size uint8 records and replace the least recently used
+one when full.  Images evicted from RAM are written to the disk level, and
+images found on disk are moved back up into RAM.'''
+
+from striate import util
+import collections
+import numpy as np
+import os
+import threading
+
+class _Tier(object):
+  '''A fixed number of equal sized records with least recently used
+  replacement.'''
+  def __init__(self, records):
+    self.records = records
+    self.slots = collections.OrderedDict()
+    self.free = range(len(records))
+
+  def __contains__(self, key):
+    return key in self.slots
+
+  def __len__(self):
+    return len(self.slots)
+
+  def get(self, key):
+    slot = self.slots.pop(key)
+    self.slots[key] = slot
+    return self.records[slot]
+
+  def put(self, key, record, on_evict):
+    '''Store a copy of record.  If the tier is full, on_evict(key, record) is
+    called with the least recently used record before its slot is reused.'''
+    if not len(self.records):
+      on_evict(key, record)
+      return
+    if self.free:
+      slot = self.free.pop()
+    else:
+      old_key, slot = self.slots.popitem(last=False)
+      on_evict(old_key, self.records[slot])
+    self.records[slot] = record
+    self.slots[key] = slot
+
+
+class ImageCache(object):
+  def __init__(self, record_shape, mem_bytes, disk_dir=None, disk_bytes=0):
+    record_shape = tuple(record_shape)
+    record_bytes = int(np.prod(record_shape))
+    self.mem = _Tier(np.empty((int(mem_bytes) // record_bytes,) + record_shape, dtype=np.uint8))
+
+    self.disk = None
+    num_disk = int(disk_bytes) // record_bytes
+    if disk_dir is not None and num_disk > 0:
+      if not os.path.exists(disk_dir):
+        os.makedirs(disk_dir)
+      path = os.path.join(disk_dir, 'image-cache-%d.dat' % os.getpid())
+      records = np.memmap(path, dtype=np.uint8, mode='w+', shape=(num_disk,) + record_shape)
+      # the mapping outlives the name, and the space is freed when we exit
+      os.unlink(path)
+      self.disk = _Tier(records)
+
+    self.hits = 0
+    self.disk_hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._lock = threading.Lock()
+
+  def fetch(self, keys, out):
+    '''Copy every cached image of keys into the same position of out, and
+    return the positions of the ones that are not cached.'''
+    missing = []
+    with self._lock:
+      for i, key in enumerate(keys):
+        if key in self.mem:
+          out[i] = self.mem.get(key)
+          self.hits += 1
+        elif self.disk is not None and key in self.disk:
+          out[i] = self.disk.get(key)
+          self.disk_hits += 1
+          self.mem.put(key, out[i], self._spill)
+        else:
+          missing.append(i)
+          self.misses += 1
+    return np.array(missing, dtype=np.int64)
+
+  def contains(self, keys):
+    '''Return a mask of the keys cached in RAM or on disk.'''
+    with self._lock:
+      return np.array([key in self.mem or (self.disk is not None and key in self.disk)
+                       for key in keys], dtype=np.bool)
+
+  def put(self, key, image):
+    with self._lock:
+      if key not in self.mem:
+        self.mem.put(key, image, self._spill)
+
+  def _spill(self, key, image):
+    if self.disk is None:
+      self.evictions += 1
+    elif key in self.disk:
+      self.disk.get(key)
+    else:
+      self.disk.put(key, image, self._drop)
+
+  def _drop(self, key, image):
+    self.evictions += 1
+
+  def log_stats(self):
+    util.log('Image cache: %d in RAM, %d on disk; %d hits, %d disk hits, %d misses, %d evictions',
+             len(self.mem), len(self.disk) if self.disk is not None else 0,
+             self.hits, self.disk_hits, self.misses, self.evictions)
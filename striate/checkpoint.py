@@ -0,0 +1,427 @@
+'''Checkpoints written in the background.
+
+Saving a checkpoint used to stop training while every layer was copied to
+the host, pickled and written.  A CheckpointWriter splits that in two:
+snapshot() copies the layers into host buffers that are reused from one
+checkpoint to the next, which is all training has to wait for, and write()
+pickles the snapshot on a background thread.
+
+A checkpoint is written under a hidden temporary name and renamed into
+place once complete, so a checkpoint is either whole or absent; the files it
+replaces are only removed after that.  At most one checkpoint is in flight:
+the next snapshot waits for the last write to finish, since it reuses its
+buffers.
+
+Checkpoints come in four formats:
+
+  pickle  the whole {'model_state': ...} dict in one cPickle file
+  dir     a directory holding manifest.pickle, the dict without its layer
+          arrays, and one .npy file per array (weight, bias, weightIncr,
+          biasIncr), which load() maps instead of reading; so a tool that
+          only looks at a few layers, or a restart that drops the
+          increments, reads just the arrays it touches.
+  blobs   a small manifest file like the dir one, whose arrays are kept
+          in the blobs/ directory next to it under the SHA-1 of their
+          contents.  An array is only written if no checkpoint has stored
+          it yet, so layers frozen by a layerwise trainer, or that did not
+          change since the last save, are hashed but not written again; blobs no checkpoint
+          refers to any more are deleted after every save, or with
+
+            python -m striate.checkpoint --collect CHECKPOINT_DIR
+
+          Storing a checkpoint and collecting hold a lock file in blobs/,
+          so runs sharing a checkpoint directory never delete the blobs
+          of a checkpoint that is still being written.
+
+  compressed
+          one file holding a manifest and then every array cut into
+          chunks compressed with zlib or bz2, which a pool of threads
+          compresses and decompresses in parallel
+
+load() tells them apart and returns the same dict for all of them.
+
+Independently of the format, a CheckpointWriter can store arrays as
+float16: half='increments' does so for the momentum buffers (weightIncr,
+biasIncr) and half='all' for every layer array, which is enough for an
+inference snapshot.  load() casts them back to float32.'''
+
+from striate import util
+import argparse
+import cPickle
+import fcntl
+from multiprocessing.pool import ThreadPool
+import bz2
+import hashlib
+import numpy as np
+import os
+import shutil
+import struct
+import threading
+import time
+import zlib
+
+MANIFEST = 'manifest.pickle'
+BLOB_DIR = 'blobs'
+BLOB_LOCK = '.lock'
+# temporary blobs older than this were left behind by a writer that died
+STALE_TMP_SECONDS = 3600
+# starts every blob checkpoint manifest, so it can be told from a pickle
+BLOB_MAGIC = 'striate blob checkpoint\n'
+COMPRESSED_MAGIC = 'striate compressed checkpoint\n'
+
+CODECS = {'zlib': (zlib.compress, zlib.decompress),
+          'bz2': (bz2.compress, bz2.decompress)}
+
+# the layer arrays each half precision policy stores as float16
+HALF_ARRAYS = {'none': (),
+               'increments': ('weightIncr', 'biasIncr'),
+               'all': ('weight', 'bias', 'weightIncr', 'biasIncr')}
+
+def temp_filename(filename):
+  '''Where a checkpoint is written before being renamed to filename.  The
+  leading dot keeps it out of globs for the checkpoint prefix.'''
+  return os.path.join(os.path.dirname(filename), '.%s.tmp' % os.path.basename(filename))
+
+
+def write_pickle(obj, filename):
+  tmp = temp_filename(filename)
+  with open(tmp, 'wb') as f:
+    cPickle.dump(obj, f, protocol=-1)
+    f.flush()
+    os.fsync(f.fileno())
+  os.rename(tmp, filename)
+
+
+def _save_array(array, filename):
+  with open(filename, 'wb') as f:
+    np.save(f, array)
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def _split_arrays(obj, store):
+  '''Return a copy of checkpoint obj without its layer arrays, and a list
+  of (layer, name, ref) with the ref store(layer index, layer name, array
+  name, array) gave each array.'''
+  manifest = dict(obj)
+  model = manifest['model_state'] = dict(obj['model_state'])
+  model['layers'] = [dict(l) for l in model['layers']]
+  arrays = []
+  for i, layer in enumerate(model['layers']):
+    for name, value in sorted(layer.items()):
+      if isinstance(value, np.ndarray):
+        arrays.append((i, name, store(i, layer.get('name', 'layer'), name, value)))
+        del layer[name]
+  return manifest, arrays
+
+
+def _join_arrays(checkpoint, arrays, path):
+  '''Map every array back into its layer, from the file path(ref).'''
+  layers = checkpoint['model_state']['layers']
+  for i, name, ref in arrays:
+    layers[i][name] = np.load(path(ref), mmap_mode='r')
+  return checkpoint
+
+
+def write_directory(obj, dirname):
+  tmp = temp_filename(dirname)
+  if os.path.exists(tmp):
+    shutil.rmtree(tmp)
+  os.makedirs(tmp)
+
+  def store(i, layer_name, name, array):
+    filename = '%02d-%s.%s.npy' % (i, layer_name, name)
+    _save_array(array, os.path.join(tmp, filename))
+    return filename
+  manifest, arrays = _split_arrays(obj, store)
+  write_pickle({'checkpoint': manifest, 'arrays': arrays}, os.path.join(tmp, MANIFEST))
+
+  remove(dirname)
+  os.rename(tmp, dirname)
+
+
+def load_directory(dirname):
+  manifest = util.load(os.path.join(dirname, MANIFEST))
+  return _join_arrays(manifest['checkpoint'], manifest['arrays'],
+                      lambda filename: os.path.join(dirname, filename))
+
+
+def blob_key(array):
+  '''The SHA-1 of an array's dtype, shape and contents.'''
+  h = hashlib.sha1('%s %s\n' % (array.dtype.str, array.shape))
+  h.update(np.ascontiguousarray(array).data)
+  return h.hexdigest()
+
+
+def _blob_path(blob_dir, key):
+  return os.path.join(blob_dir, key + '.npy')
+
+
+class _BlobLock(object):
+  '''An exclusive flock on blobs/.lock.  write_blobs holds it from the first
+  blob to the rename of the manifest, and collect_blobs while it decides what
+  is dead, so a collect never sees blobs whose manifest is not there yet.'''
+  def __init__(self, blob_dir):
+    self.filename = os.path.join(blob_dir, BLOB_LOCK)
+
+  def __enter__(self):
+    self.f = open(self.filename, 'a')
+    fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+    return self
+
+  def __exit__(self, *exc):
+    fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+    self.f.close()
+
+
+def write_blobs(obj, filename):
+  blob_dir = os.path.join(os.path.dirname(filename), BLOB_DIR)
+  if not os.path.exists(blob_dir):
+    os.makedirs(blob_dir)
+
+  def store(i, layer_name, name, array):
+    key = blob_key(array)
+    path = _blob_path(blob_dir, key)
+    if not os.path.exists(path):
+      tmp = temp_filename(path)
+      _save_array(array, tmp)
+      os.rename(tmp, path)
+    return key
+
+  with _BlobLock(blob_dir):
+    manifest, arrays = _split_arrays(obj, store)
+
+    tmp = temp_filename(filename)
+    with open(tmp, 'wb') as f:
+      f.write(BLOB_MAGIC)
+      cPickle.dump({'checkpoint': manifest, 'arrays': arrays}, f, protocol=-1)
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(tmp, filename)
+
+
+def _read_blob_manifest(filename):
+  '''Return the manifest of a blob checkpoint, or None for any other file.'''
+  with open(filename, 'rb') as f:
+    if f.read(len(BLOB_MAGIC)) != BLOB_MAGIC:
+      return None
+    return cPickle.load(f)
+
+
+def _has_magic(filename, magic):
+  with open(filename, 'rb') as f:
+    return f.read(len(magic)) == magic
+
+
+def load_blobs(filename, manifest=None):
+  if manifest is None:
+    manifest = _read_blob_manifest(filename)
+  blob_dir = os.path.join(os.path.dirname(filename), BLOB_DIR)
+  return _join_arrays(manifest['checkpoint'], manifest['arrays'],
+                      lambda key: _blob_path(blob_dir, key))
+
+
+def collect_blobs(checkpoint_dir):
+  '''Delete the blobs no blob checkpoint in checkpoint_dir refers to, and the
+  temporary blobs of writers that died, and return how many bytes that
+  freed.'''
+  blob_dir = os.path.join(checkpoint_dir, BLOB_DIR)
+  if not os.path.isdir(blob_dir):
+    return 0
+
+  freed = 0
+  with _BlobLock(blob_dir):
+    live = set()
+    for f in os.listdir(checkpoint_dir):
+      path = os.path.join(checkpoint_dir, f)
+      if f.startswith('.') or not os.path.isfile(path):
+        continue
+      manifest = _read_blob_manifest(path)
+      if manifest is not None:
+        live.update(key for _, _, key in manifest['arrays'])
+
+    stale = time.time() - STALE_TMP_SECONDS
+    for f in os.listdir(blob_dir):
+      path = os.path.join(blob_dir, f)
+      if f.endswith('.npy') and not f.startswith('.'):
+        dead = f[:-len('.npy')] not in live
+      else:
+        # writers hold the lock, but a blob directory on a file system
+        # without flock still only loses temporaries that are long dead
+        dead = f.endswith('.tmp') and os.path.getmtime(path) < stale
+      if dead:
+        freed += os.path.getsize(path)
+        os.remove(path)
+  return freed
+
+
+def write_compressed(obj, filename, codec='zlib', num_threads=4, chunk_bytes=4 << 20):
+  '''After COMPRESSED_MAGIC, the file holds the length of the pickled
+  manifest as a little endian uint64, the manifest, and the compressed
+  chunks of every array one after the other.'''
+  chunks = []
+  def store(i, layer_name, name, array):
+    array = np.ascontiguousarray(array)
+    raw = array.reshape(-1).view(np.uint8)
+    starts = range(0, raw.nbytes, chunk_bytes)
+    chunks.extend(raw[start:start + chunk_bytes] for start in starts)
+    return {'dtype': array.dtype.str, 'shape': array.shape, 'chunks': len(starts)}
+  manifest, arrays = _split_arrays(obj, store)
+
+  compress = CODECS[codec][0]
+  pool = ThreadPool(num_threads)
+  try:
+    packed = pool.map(compress, chunks)
+  finally:
+    pool.close()
+
+  header = cPickle.dumps({'checkpoint': manifest, 'arrays': arrays, 'codec': codec,
+                          'chunk_sizes': [len(p) for p in packed]}, protocol=-1)
+  tmp = temp_filename(filename)
+  with open(tmp, 'wb') as f:
+    f.write(COMPRESSED_MAGIC)
+    f.write(struct.pack('<Q', len(header)))
+    f.write(header)
+    for p in packed:
+      f.write(p)
+    f.flush()
+    os.fsync(f.fileno())
+  os.rename(tmp, filename)
+
+
+def load_compressed(filename, num_threads=4):
+  '''Arrays are read and decompressed one at a time, each chunk copied into
+  its array as soon as it is inflated, so no more than one array's
+  compressed bytes are held besides the checkpoint itself.'''
+  pool = ThreadPool(num_threads)
+  try:
+    with open(filename, 'rb') as f:
+      f.read(len(COMPRESSED_MAGIC))
+      header_size, = struct.unpack('<Q', f.read(8))
+      manifest = cPickle.loads(f.read(header_size))
+      decompress = CODECS[manifest['codec']][1]
+      chunk_sizes = iter(manifest['chunk_sizes'])
+
+      checkpoint = manifest['checkpoint']
+      layers = checkpoint['model_state']['layers']
+      for i, name, ref in manifest['arrays']:
+        array = np.empty(ref['shape'], dtype=np.dtype(ref['dtype']))
+        raw = array.reshape(-1).view(np.uint8)
+        packed = [f.read(next(chunk_sizes)) for c in range(ref['chunks'])]
+        offset = 0
+        for chunk in pool.imap(decompress, packed):
+          raw[offset:offset + len(chunk)] = np.frombuffer(chunk, dtype=np.uint8)
+          offset += len(chunk)
+        layers[i][name] = array
+  finally:
+    pool.close()
+  return checkpoint
+
+
+def to_half(obj, names):
+  '''Return a copy of checkpoint obj with the given layer arrays as float16.'''
+  if not names:
+    return obj
+  obj = dict(obj)
+  model = obj['model_state'] = dict(obj['model_state'])
+  model['layers'] = [dict(l) for l in model['layers']]
+  for layer in model['layers']:
+    for name in names:
+      if isinstance(layer.get(name), np.ndarray) and layer[name].dtype == np.float32:
+        layer[name] = layer[name].astype(np.float16)
+  return obj
+
+
+def upcast(checkpoint):
+  '''Cast the float16 layer arrays of a loaded checkpoint back to float32,
+  which is what the layers compute in.'''
+  if 'model_state' in checkpoint:
+    for layer in checkpoint['model_state']['layers']:
+      for name, value in layer.items():
+        if isinstance(value, np.ndarray) and value.dtype == np.float16:
+          layer[name] = value.astype(np.float32)
+  return checkpoint
+
+
+def load(filename):
+  '''Load a checkpoint in any format.'''
+  if os.path.isdir(filename):
+    return upcast(load_directory(filename))
+  if _has_magic(filename, COMPRESSED_MAGIC):
+    return upcast(load_compressed(filename))
+  manifest = _read_blob_manifest(filename)
+  if manifest is not None:
+    return upcast(load_blobs(filename, manifest))
+  return upcast(util.load(filename))
+
+
+def remove(filename):
+  if os.path.isdir(filename):
+    shutil.rmtree(filename)
+  elif os.path.exists(filename):
+    os.remove(filename)
+
+
+FORMATS = {'pickle': write_pickle, 'dir': write_directory, 'blobs': write_blobs,
+           'compressed': write_compressed}
+
+class CheckpointWriter(object):
+  '''options are handed on to the format's write function, e.g. codec and
+  num_threads for the compressed format.'''
+  def __init__(self, format='pickle', half='none', **options):
+    assert format in FORMATS, 'Unknown checkpoint format %s, expected one of %s' % (format, sorted(FORMATS))
+    assert half in HALF_ARRAYS, 'Unknown half precision policy %s, expected one of %s' % (half, sorted(HALF_ARRAYS))
+    self.format = format
+    self.half = half
+    self.options = options
+    # one dict of host arrays per layer position
+    self._hosts = []
+    self._thread = None
+    self._error = None
+
+  def snapshot(self, net):
+    '''Return the dumped layers of net, with their arrays in the writer's
+    host buffers.  They stay valid until the next snapshot.'''
+    self.wait()
+    while len(self._hosts) < len(net.layers):
+      self._hosts.append({})
+    return net.get_dumped_layers(self._hosts)
+
+  def write(self, obj, filename, replaces=()):
+    '''Start writing obj to filename, then removing the files in replaces.'''
+    self.wait()
+    self._thread = threading.Thread(target=self._write, args=(obj, filename, replaces))
+    self._thread.setDaemon(True)
+    self._thread.start()
+
+  def _write(self, obj, filename, replaces):
+    try:
+      FORMATS[self.format](to_half(obj, HALF_ARRAYS[self.half]), filename, **self.options)
+      for old in replaces:
+        if old != filename:
+          remove(old)
+      if self.format == 'blobs':
+        freed = collect_blobs(os.path.dirname(filename))
+        if freed:
+          util.log('Freed %.1f MB of unreferenced checkpoint blobs', freed / 2.0 ** 20)
+      util.log('Wrote checkpoint %s', filename)
+    except Exception, e:
+      util.log('Failed to write checkpoint %s', filename, exc_info=1)
+      self._error = e
+
+  def wait(self):
+    '''Block until the checkpoint in flight is on disk, and raise whatever
+    error writing it hit.'''
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+    if self._error is not None:
+      error, self._error = self._error, None
+      raise error
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--collect', help = 'Delete the unreferenced blobs of this checkpoint directory', required = True)
+  args = parser.parse_args()
+  util.log('Freed %d bytes', collect_blobs(args.collect))
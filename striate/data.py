@@ -1,28 +1,203 @@
 from PIL import Image
-from os.path import basename
-from striate import util
-import Queue
-import cPickle
+from striate import augment, util
+from striate.augment import Pipeline
+from striate.cache import ImageCache
+from striate.image_index import ImageIndex, TarIndex, TarMember, read_member
+from striate.readahead import Readahead
+from striate.shard import ShardReader
+from striate.sharedmem import SharedBatchPool
 import collections
-import glob
+import io
+import multiprocessing
 import numpy as np
 import os
 import random
 import re
+import signal
 import sys
 import threading
 import time
 
+# When a provider emits raw uint8 pixels, `mean` is the image mean the
+# consumer still has to subtract; it is None for normalized float batches.
 BatchData = collections.namedtuple('BatchData',
-                                   ['data', 'labels', 'epoch', 'batchnum'])
+                                   ['data', 'labels', 'epoch', 'batchnum', 'mean'])
+BatchData.__new__.__defaults__ = (None,)
 
 
 dp_dict = {}
 
+
+def _open_image(source, img_size=None, times=None):
+  '''Open a JPEG file name, file object or TarMember as an RGB image.  If
+  img_size is given, the short side is scaled to img_size and the central
+  img_size square is cut out.
+
+  The decoder is asked to scale by 1/2, 1/4 or 1/8 while it decodes, to the
+  smallest size that still covers img_size, so a large photo is never
+  decoded at full resolution only to be shrunk.
+
+  The seconds spent reading, decoding and converting the image are added to
+  the read, decode and convert entries of times if it is given.'''
+  if times is None:
+    times = collections.defaultdict(float)
+  st = time.time()
+  if isinstance(source, TarMember):
+    raw = read_member(source)
+  elif isinstance(source, basestring):
+    with open(source, 'rb') as f:
+      raw = f.read()
+  else:
+    raw = source.read()
+  times['read'] += time.time() - st
+
+  st = time.time()
+  jpeg = Image.open(io.BytesIO(raw))
+  if img_size is not None and jpeg.size != (img_size, img_size):
+    jpeg.draft('RGB', (img_size, img_size))
+    cols, rows = jpeg.size
+    side = min(cols, rows)
+    left, top = (cols - side) / 2, (rows - side) / 2
+    if side != cols or side != rows:
+      jpeg = jpeg.crop((left, top, left + side, top + side))
+    if side != img_size:
+      jpeg = jpeg.resize((img_size, img_size), Image.ANTIALIAS)
+  jpeg.load()
+  times['decode'] += time.time() - st
+
+  st = time.time()
+  if jpeg.mode != "RGB": jpeg = jpeg.convert("RGB")
+  times['convert'] += time.time() - st
+  return jpeg
+
+
+def _decode_jpegs(filenames, img_size=None, out=None, positions=None, times=None):
+  '''Decode a list of JPEGs (anything _open_image takes) into a
+  (n, 3, rows, cols) uint8 array, scaling and cropping them to img_size x
+  img_size if it is given.  When out is given the images are written into
+  it, image i at out[positions[i]] if positions is given, and it is
+  returned.  Stage times are added to times as in _open_image.
+
+  Runs inside the decode worker processes, so it must stay a module level
+  function.'''
+  if times is None:
+    times = collections.defaultdict(float)
+  images = []
+  for idx, filename in enumerate(filenames):
+    jpeg = _open_image(filename, img_size, times)
+    st = time.time()
+    # starts as rows * cols * rgb, tranpose to rgb * rows * cols
+    img = np.asarray(jpeg, np.uint8).transpose(2, 0, 1)
+    if out is None:
+      images.append(img)
+    else:
+      out[idx if positions is None else positions[idx]] = img
+    times['convert'] += time.time() - st
+  if out is None:
+    return np.array(images, dtype=np.uint8)
+  return out
+
+
+def crop_batch(images, target, ys, xs, flips, inner_size, index=None, sample_major=False):
+  '''Crop an inner_size square out of every image of a (n, 3, rows, cols)
+  batch at (ys[i], xs[i]), mirror the crops where flips[i] is set, and write
+  crop i into column i of target (row i if sample_major).  If index is given,
+  crop i is taken from images[index[i]] instead, so one image can yield
+  several crops.'''
+  crops = augment.crop(images, ys, xs, inner_size, index)
+  crops[flips] = crops[flips, :, :, ::-1]
+  write_batch(crops, target, sample_major)
+
+
+def write_batch(images, target, sample_major=False):
+  '''Write image i of a (n, 3, rows, cols) batch into column i of target,
+  or row i if sample_major.'''
+  if sample_major:
+    target[:len(images)] = images.reshape((len(images), -1))
+  else:
+    target[:, :len(images)] = images.reshape((len(images), -1)).T
+
+
+# Set in each decode worker process by _init_decode_worker.
+_worker_batch_pool = None
+_worker_images_shape = None
+
+def _init_decode_worker(batch_pool, images_shape):
+  global _worker_batch_pool, _worker_images_shape
+  _worker_batch_pool = batch_pool
+  _worker_images_shape = images_shape
+
+  # The trainer has its CUDA context from the moment the kernels are
+  # imported, so the workers are forked from a process that holds one.  They
+  # never use it, but must not keep the GPU open either: a worker outliving
+  # a crashed trainer would otherwise pin the device memory until it dies.
+  # Ctrl-C is left to the parent, which terminates the pool.
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  fd_dir = '/proc/self/fd'
+  if os.path.isdir(fd_dir):
+    for fd in os.listdir(fd_dir):
+      try:
+        if os.readlink(os.path.join(fd_dir, fd)).startswith('/dev/nvidia'):
+          os.close(int(fd))
+      except OSError:
+        pass
+
+
+def _start_decode_pool(num_workers, batch_pool, images_shape):
+  '''Fork num_workers processes decoding into the slots of batch_pool, which
+  has to exist first.  Forking before the first CUDA call keeps the workers
+  clean; callers that can should build their providers early.'''
+  return multiprocessing.Pool(num_workers, _init_decode_worker, (batch_pool, images_shape))
+
+
+def _stop_decode_pool(pool):
+  if pool is not None:
+    pool.terminate()
+    pool.join()
+
+def _decode_into_slot(args):
+  '''Decode filenames into the given positions of the 'images' buffer of a
+  shared batch slot, and return the time spent in each stage.'''
+  slot, positions, filenames = args
+  images = _worker_batch_pool.view(slot, 'images', _worker_images_shape, np.uint8)
+  times = collections.defaultdict(float)
+  _decode_jpegs(filenames, _worker_images_shape[-1], out=images, positions=positions, times=times)
+  return dict(times)
+
+
 class DataProvider(object):
   BATCH_REGEX = re.compile('^data_batch_(\d+)$')
-  def __init__(self, data_dir='.', batch_range=None):
+  # Multiview providers return num_views crops of every image, view by view:
+  # column (or row) v * n + i of a batch of n images holds view v of image i.
+  multiview = False
+  num_views = 1
+  # Whether sharding splits batch_range between the ranks; providers that
+  # share out individual images instead turn this off.
+  shard_batches = True
+  def __init__(self, data_dir='.', batch_range=None, test=False, raw_pixels=False,
+               sample_major=False, augment=None, rank=0, world_size=1, seed=None):
     self.data_dir = data_dir
+    self.test = test
+    # emit uint8 batches and leave the mean subtraction to the consumer
+    self.raw_pixels = raw_pixels
+    # Batches are (dims, n) with one image per column by default.  Sample
+    # major batches are (n, dims) instead: every image is one contiguous row
+    # and a minibatch is a contiguous slice; `mean` stays a (dims, 1) column.
+    self.sample_major = sample_major
+    # When world_size processes share the data, each one serves a disjoint
+    # shard of the same size.  The ranks agree on the split by shuffling with
+    # the same seed, so one has to be given (or the default used) by all.
+    assert 0 <= rank < world_size, 'Rank %d out of range for %d workers' % (rank, world_size)
+    self.rank = rank
+    self.world_size = world_size
+    if seed is None:
+      seed = 0 if world_size > 1 else random.randint(0, 2 ** 31 - 1)
+    self.seed = seed
+    # an augment.Pipeline, or its spec, to run over every training batch;
+    # a spec is seeded like the rest of the provider
+    if isinstance(augment, basestring):
+      augment = Pipeline.parse(augment, self.seed)
+    self.augment = None if test else augment
     self.meta_file = os.path.join(data_dir, 'batches.meta')
 
     self.curr_batch_index = 0
@@ -30,6 +205,12 @@ class DataProvider(object):
     self.curr_epoch = 1
     self.data = None
 
+    # seconds spent in each loading stage, summed over every thread and
+    # worker, and how long each of the latest batches took to load
+    self.timings = collections.defaultdict(float)
+    self.load_times = collections.deque(maxlen=10000)
+    self._timing_lock = threading.Lock()
+
     if os.path.exists(self.meta_file):
       self.batch_meta = util.load(self.meta_file)
     else:
@@ -39,8 +220,25 @@ class DataProvider(object):
       self.batch_range = self.get_batch_indexes()
     else:
       self.batch_range = batch_range
-    random.shuffle(self.batch_range)
+    random.Random(self.seed).shuffle(self.batch_range)
+    if self.shard_batches:
+      self.batch_range = self.shard(self.batch_range)
+
+
+  def shard(self, items):
+    '''Return this rank's share of items: every world_size-th one starting
+    at rank, leaving out the remainder so that every rank gets as many.'''
+    count = len(items) // self.world_size
+    assert count > 0, 'Only %d items to share between %d ranks, rank %d would get none' % (
+        len(items), self.world_size, self.rank)
+    return items[self.rank::self.world_size][:count]
 
+  def _add_times(self, times, load_time=None):
+    with self._timing_lock:
+      for name, seconds in times.items():
+        self.timings[name] += seconds
+      if load_time is not None:
+        self.load_times.append(load_time)
 
   def get_next_index(self):
     self.curr_batch_index = (self.curr_batch_index + 1) % len(self.batch_range)
@@ -49,6 +247,39 @@ class DataProvider(object):
   def get_next_batch(self):
     return self._get_next_batch()
 
+  def _get_next_batch(self):
+    return self._load_batch(*self._advance())
+
+  def _advance(self):
+    '''Move to the next batch and return its (epoch, batchnum).'''
+    assert False, 'No implementation for _advance'
+
+  def _load_batch(self, epoch, batchnum):
+    '''Read batch `batchnum` and return it as a BatchData.
+
+    May be called from several reader threads at once, so it must not touch
+    the iteration state that _advance keeps.'''
+    assert False, 'No implementation for _load_batch'
+
+  def _check_augment(self, input_shape):
+    '''Fail here, rather than on the reader thread at every batch, if the
+    augmentation does not turn input_shape images into image_shape ones.'''
+    if self.augment is not None:
+      shape = self.augment.output_shape(input_shape)
+      assert shape == self.image_shape, \
+          'Augmentation has to turn %s images into %s, got %s' % (input_shape, self.image_shape, shape)
+
+  def get_num_cases(self, batch):
+    '''The number of columns (rows if sample major) of a batch.'''
+    return batch.data.shape[0] if self.sample_major else batch.data.shape[1]
+
+  def batch_shape(self, dims, num_cases):
+    return (num_cases, dims) if self.sample_major else (dims, num_cases)
+
+  def close(self):
+    '''Release whatever the provider holds besides memory.'''
+    pass
+
   def del_batch(self, batch):
     print 'delete batch', batch
     self.batch_range.remove(batch)
@@ -74,81 +305,319 @@ class DataProvider(object):
 
 
 class ParallelDataProvider(DataProvider):
-  def __init__(self, data_dir='.', batch_range=None):
-    DataProvider.__init__(self, data_dir, batch_range)
-    self._reader = None
-    self._batch_return = None
-    self._data_queue = Queue.Queue(1)
+  '''Loads batches ahead of the trainer on background threads.
+
+  `num_readers` threads load batches concurrently and may finish them out of
+  order; at most prefetch + num_readers batches are loading or finished and
+  waiting for the trainer at any time, so up to that many can be waiting
+  once every reader is done.  Batches are still handed out in the order
+  _advance produced them.
+
+  With readahead > 0, the files of the batches the readers will load next
+  are hinted to the OS, up to readahead bytes ahead of them.'''
+  def __init__(self, data_dir='.', batch_range=None, prefetch=1, num_readers=1, readahead=0, **kw):
+    DataProvider.__init__(self, data_dir, batch_range, **kw)
+    self.prefetch = prefetch
+    self.num_readers = num_readers
+    self._readers = []
+    self._advance_lock = threading.Lock()
+    # one credit per batch that may be loading or waiting at any time
+    self._credits = threading.Semaphore(self.prefetch + self.num_readers)
+    self._ready = threading.Condition()
+    self._finished = {}
+    self._next_seq = 0
+    self._next_out = 0
+    self._current = None
+    self._batch_pool = None
+    self._closed = False
+    self._readahead = Readahead(readahead) if readahead > 0 else None
+    self._num_advanced = 0
+    self._num_hinted = 0
 
   def _start_read(self):
-    assert self._reader is None
-    self._reader = threading.Thread(target=self.run_in_back)
-    self._reader.setDaemon(True)
-    self._reader.start()
+    assert not self._readers
+    for i in range(self.num_readers):
+      reader = threading.Thread(target=self.run_in_back)
+      reader.setDaemon(True)
+      reader.start()
+      self._readers.append(reader)
 
   def run_in_back(self):
     while 1:
-      result = self._get_next_batch()
-      self._data_queue.put(result)
+      self._credits.acquire()
+      if self._closed:
+        return
+      # whatever goes wrong is handed to the trainer in place of batch seq,
+      # which it is waiting for
+      epoch = batchnum = None
+      try:
+        with self._advance_lock:
+          seq = self._next_seq
+          self._next_seq += 1
+          epoch, batchnum = self._advance()
+          if self._readahead is not None:
+            self._hint_ahead()
+        result = self._load_batch(epoch, batchnum)
+      except Exception, e:
+        util.log('Failed to load batch %s.%s', epoch, batchnum, exc_info=1)
+        result = e
+      if self._readahead is not None and epoch is not None:
+        self._readahead.release((epoch, batchnum))
+
+      with self._ready:
+        self._finished[seq] = result
+        self._ready.notifyAll()
+
+  def close(self):
+    '''Stop the readers once they finish the batches they are loading.'''
+    self._closed = True
+    for reader in self._readers:
+      self._credits.release()
+    for reader in self._readers:
+      reader.join()
+    self._readers = []
+
+    # hand back the slots of the batches nobody is going to take now
+    with self._ready:
+      held = self._finished.values()
+      self._finished.clear()
+    if self._current is not None:
+      held.append(self._current)
+      self._current = None
+    for batch in held:
+      if isinstance(batch, BatchData):
+        self._release_batch(batch)
+
+    if self._readahead is not None:
+      self._readahead.close()
+      self._readahead = None
+
+  def _batch_sources(self, epoch, batchnum):
+    '''Return the files (paths or (path, offset, size) extents) a batch
+    will read, or None if there is nothing worth reading ahead.'''
+    return None
+
+  def _hint_ahead(self):
+    '''Hint the batches the next prefetch + num_readers calls of _advance
+    will return.  Called with the advance lock held, right after _advance.
+
+    Only batches of the current epoch are hinted, as the next one may be
+    shuffled differently; a hinted batch that is never loaded would hold on
+    to its share of the budget.'''
+    self._num_advanced += 1
+    window = self.prefetch + self.num_readers
+    for advanced in range(max(self._num_hinted, self._num_advanced) + 1, self._num_advanced + window + 1):
+      index = self.curr_batch_index + advanced - self._num_advanced
+      if index >= len(self.batch_range):
+        break
+      batchnum = self.batch_range[index]
+      sources = self._batch_sources(self.curr_epoch, batchnum)
+      if sources is not None:
+        self._readahead.hint((self.curr_epoch, batchnum), sources)
+      self._num_hinted = advanced
+
+  def _init_batch_pool(self, buffer_bytes):
+    '''Allocate shared memory slots to assemble batches in, one per batch
+    that can be loading, waiting, or held by the trainer.'''
+    self._batch_pool = SharedBatchPool(self.prefetch + self.num_readers + 1, buffer_bytes)
+    self._batch_slots = {}
+    self._slot_group = None
+
+  def _acquire_slot(self, epoch, batchnum):
+    slot = self._batch_pool.acquire(self._slot_group)
+    self._batch_slots[epoch, batchnum] = slot
+    return slot
+
+  def _release_batch(self, batch):
+    '''Called once the trainer is done with a batch returned earlier.'''
+    if self._batch_pool is not None:
+      self._batch_pool.release(self._batch_slots.pop((batch.epoch, batch.batchnum)))
 
   def get_next_batch(self):
-    if self._reader is None:
+    '''Return the next batch.  Its arrays may live in a reused buffer, so
+    they are only valid until the following call.'''
+    if not self._readers:
       self._start_read()
 
-    return self._data_queue.get()
+    if self._current is not None:
+      self._release_batch(self._current)
+      self._current = None
+
+    with self._ready:
+      while self._next_out not in self._finished:
+        self._ready.wait()
+      result = self._finished.pop(self._next_out)
+      self._next_out += 1
+    self._credits.release()
+
+    if isinstance(result, Exception):
+      raise result
+    self._current = result
+    return result
+
+
+class SampleStore(object):
+  '''What every ImageNet provider over one data directory can share: the
+  category index, the image mean, the image cache, and the batch slots with
+  the decode workers writing into them.
+
+  Trainers that replace their providers between stages keep one store and
+  hand it to every new provider as store=, so a stage change only selects
+  images from the index: nothing is rescanned or reloaded, no worker is
+  forked again and the cache stays warm.  The slots are allocated (and the
+  workers forked) when the first provider attaches, with room for
+  num_providers providers of the same kind loading at once; a provider has
+  to be closed before the one replacing it is built.  With multiview, one of
+  them is a multiview test provider, whose slots are a group of their own
+  with room for every view; the others only get single view slots.'''
+  PARAMS = ['num_workers', 'cache_mem', 'cache_dir', 'cache_disk', 'multiview']
+
+  def __init__(self, data_dir, num_providers=2, num_workers=0, cache_mem=0, cache_dir=None, cache_disk=0,
+               multiview=False):
+    self.data_dir = data_dir
+    self.num_providers = num_providers
+    self.multiview = multiview
+    self.num_workers = num_workers
+    self.batch_meta = util.load(os.path.join(data_dir, 'batches.meta'))
+    self.image_mean = util.load(os.path.join(data_dir, 'image-mean.pickle'))
+    self.batch_pool = None
+    self.pool = None
+    self.cache = None
+    self._cache_params = (cache_mem, cache_dir, cache_disk)
+    self._indexes = {}
+    self._lock = threading.Lock()
+
+  def open_index(self, index_class):
+    with self._lock:
+      if index_class not in self._indexes:
+        self._indexes[index_class] = index_class.open(self.data_dir, self.batch_meta)
+      return self._indexes[index_class]
+
+  def attach(self, num_slots, buffer_bytes, images_shape, decodes=True, caches=True,
+             view_bytes=None, multiview=False):
+    '''Called by every provider built over the store, with the slots it
+    needs and their sizes, and view_bytes, the buffers that grow for
+    multiview batches at their multiview size.  Returns the slot group the
+    provider takes its slots from.  The decode workers and the cache are
+    only set up once a provider that decodes JPEGs, or caches images, needs
+    them.'''
+    with self._lock:
+      if self.batch_pool is None:
+        self._images_shape = images_shape
+        self._buffer_bytes = buffer_bytes
+        num_single = self.num_providers - 1 if self.multiview else self.num_providers
+        self.batch_pool = SharedBatchPool(num_slots * max(num_single, 1), buffer_bytes)
+        if self.multiview:
+          self._view_bytes = dict(buffer_bytes)
+          self._view_bytes.update(view_bytes or {})
+          self.batch_pool.add_group('views', num_slots, self._view_bytes)
+
+      assert images_shape == self._images_shape, \
+          'Providers of a store need the same batch shape, %s != %s' % (images_shape, self._images_shape)
+      assert self.multiview or not multiview, 'A multiview provider needs a store built with multiview'
+      group_bytes = self._view_bytes if multiview else self._buffer_bytes
+      for name, nbytes in buffer_bytes.items():
+        if multiview and name in view_bytes:
+          nbytes = view_bytes[name]
+        assert nbytes <= group_bytes.get(name, 0), 'Slot buffer %s too small for the provider' % name
+
+      if decodes and self.pool is None and self.num_workers > 0:
+        self.pool = _start_decode_pool(self.num_workers, self.batch_pool, images_shape)
+      cache_mem, cache_dir, cache_disk = self._cache_params
+      if caches and self.cache is None and (cache_mem > 0 or cache_disk > 0):
+        self.cache = ImageCache(images_shape[1:], cache_mem, cache_dir, cache_disk)
+      return 'views' if multiview else None
+
+  def close(self):
+    _stop_decode_pool(self.pool)
+    self.pool = None
 
 
 class ImageNetDataProvider(ParallelDataProvider):
-  def __init__(self, data_dir, batch_range=None, category_range=None, batch_size=128):
-    ParallelDataProvider.__init__(self, data_dir, batch_range)
+  shard_batches = False
+  # whether images come from JPEGs, which a pool of num_workers processes
+  # decodes, and whether the decoded images are worth keeping in an ImageCache
+  decodes_jpegs = True
+  caches_images = True
+  def __init__(self, data_dir, batch_range=None, category_range=None, batch_size=128,
+               num_workers=0, multiview=False, cache_mem=0, cache_dir=None, cache_disk=0, store=None, **kw):
+    ParallelDataProvider.__init__(self, data_dir, batch_range, **kw)
     self.img_size = 256
     self.border_size = 16
     self.inner_size = 224
     self.batch_size = batch_size
 
-    # self.multiview = dp_params['multiview_test'] and test
-    self.multiview = 0
+    # the four corners, the centre and their mirror images
+    self.multiview = multiview and self.test
     self.num_views = 5 * 2
     self.data_mult = self.num_views if self.multiview else 1
 
-    self.buffer_idx = 0
-
-    dirs = glob.glob(data_dir + '/n*')
-    synid_to_dir = {}
-    for d in dirs:
-      synid_to_dir[basename(d)[1:]] = d
+    # Batches are assembled in shared memory slots: the decoded images are
+    # written to 'images' and the cropped, mean subtracted batch handed to
+    # the trainer is a view of 'data'.
+    self._images_shape = (self.batch_size, 3, self.img_size, self.img_size)
+    self._check_augment(self._images_shape[1:])
+    self._data_dtype = np.uint8 if self.raw_pixels else np.single
+    data_bytes = self.get_data_dims() * self.batch_size * np.dtype(self._data_dtype).itemsize
 
-    if category_range is None:
-      cat_dirs = dirs
+    # With a SampleStore (whose num_workers and cache_* win over ours), the
+    # slots, decode workers and cache are the store's; a multiview test
+    # provider takes its slots from the store's group of view sized ones.
+    self._store = store
+    if not self.caches_images and (cache_mem > 0 or cache_disk > 0):
+      util.log('%s does not cache images, ignoring cache_mem and cache_disk', self.__class__.__name__)
+      cache_mem = cache_disk = 0
+    if not self.decodes_jpegs:
+      num_workers = 0
+    if store is not None:
+      self._slot_group = store.attach(self.prefetch + self.num_readers + 1,
+                                      {'images': np.prod(self._images_shape), 'data': data_bytes},
+                                      self._images_shape, self.decodes_jpegs, self.caches_images,
+                                      {'data': data_bytes * self.num_views}, self.multiview)
+      self._batch_pool = store.batch_pool
+      self._batch_slots = {}
+      self._pool = store.pool if self.decodes_jpegs else None
+      self.num_workers = store.num_workers if self._pool is not None else 0
+      self._cache = store.cache if self.caches_images else None
     else:
-      cat_dirs = []
-      for i in category_range:
-        synid = self.batch_meta['label_to_synid'][i]
-        # util.log('Using category: %d, synid: %s, label: %s', i, synid, self.batch_meta['label_names'][i])
-        cat_dirs.append(synid_to_dir[synid])
+      self._init_batch_pool({'images': np.prod(self._images_shape),
+                             'data': data_bytes * self.data_mult})
 
-    self.images = []
-    batch_dict = dict((k, k) for k in self.batch_range)
+      # JPEG decoding is spread over a pool of worker processes that write
+      # straight into the slots; with no workers everything is decoded on the
+      # reader thread.  The pool has to be forked after the slots exist.
+      self.num_workers = num_workers
+      self._pool = None
+      if self.num_workers > 0:
+        self._pool = _start_decode_pool(self.num_workers, self._batch_pool, self._images_shape)
 
-    for d in cat_dirs:
-      imgs = [v for i, v in enumerate(glob.glob(d + '/*.jpg')) if i in batch_dict]
-      self.images.extend(imgs)
+      # decoded images, kept across epochs in up to cache_mem bytes of RAM and
+      # cache_disk bytes of a file in cache_dir
+      self._cache = None
+      if cache_mem > 0 or cache_disk > 0:
+        self._cache = ImageCache(self._images_shape[1:], cache_mem, cache_dir, cache_disk)
 
-    self.images = np.array(self.images)
+    self.buffer_idx = 0
+
+    self._list_images(category_range)
 
     # build index vector into 'images' and split into groups of batch-size
-    image_index = np.arange(len(self.images))
-    np.random.shuffle(image_index)
+    rng = np.random.RandomState(self.seed)
+    image_index = self.shard(rng.permutation(len(self.images)))
 
     self.batches = np.array_split(image_index,
-                                  util.divup(len(self.images), batch_size))
+                                  util.divup(len(image_index), batch_size))
 
     self.batch_range = range(len(self.batches))
 
-    util.log('Starting data provider with %d batches', len(self.batches))
-    np.random.shuffle(self.batch_range)
+    util.log('Starting data provider with %d batches (rank %d of %d)',
+             len(self.batches), self.rank, self.world_size)
+    rng.shuffle(self.batch_range)
 
-    imagemean = cPickle.loads(open(data_dir + "image-mean.pickle").read())
+    if store is not None:
+      imagemean = store.image_mean
+    else:
+      imagemean = util.load(os.path.join(data_dir, 'image-mean.pickle'))
     self.data_mean = (imagemean['data']
         .astype(np.single)
         .T
@@ -156,66 +625,147 @@ class ImageNetDataProvider(ParallelDataProvider):
         .reshape((self.get_data_dims(), 1)))
 
 
-  def __trim_borders(self, images, target):
-    for idx, img in enumerate(images):
-      # startY, startX = np.random.randint(0, self.border_size * 2 + 1), np.random.randint(0, self.border_size * 2 + 1)
-      startY, startX = 0, 0
-      endY, endX = startY + self.inner_size, startX + self.inner_size
-      pic = img[:, startY:endY, startX:endX]
-      if np.random.randint(2) == 0:  # also flip the image with 50% probability
-        pic = pic[:, :, ::-1]
-      target[:, idx] = pic.reshape((self.get_data_dims(),))
+  def close(self):
+    try:
+      ParallelDataProvider.close(self)
+    finally:
+      # the store's pool is the store's to stop
+      if self._store is None:
+        _stop_decode_pool(self._pool)
+      self._pool = None
 
-  def _get_next_batch(self):
-    start = time.time()
+  def _open_index(self, index_class):
+    if self._store is not None:
+      return self._store.open_index(index_class)
+    return index_class.open(self.data_dir, self.batch_meta)
+
+  def _list_images(self, category_range):
+    '''Fill self.images with whatever _read_images needs to fetch each image,
+    and self.labels with the matching labels.'''
+    self._index = self._open_index(ImageIndex)
+    self.images = self._index.select(category_range, self.batch_range)
+    self.labels = self._index.labels[self.images].astype(np.single)
+
+  def _trim_borders(self, images, target):
+    num_imgs = len(images)
+    if self.multiview:
+      far = self.border_size * 2
+      view_ys = np.array([0, 0, far, far, self.border_size] * 2)
+      view_xs = np.array([0, far, 0, far, self.border_size] * 2)
+      view_flips = np.arange(self.num_views) >= self.num_views / 2
+      crop_batch(images, target,
+                 np.repeat(view_ys, num_imgs), np.repeat(view_xs, num_imgs),
+                 np.repeat(view_flips, num_imgs), self.inner_size,
+                 index=np.tile(np.arange(num_imgs), self.num_views),
+                 sample_major=self.sample_major)
+      return
+
+    if self.test:
+      # centre crop, no flipping
+      ys = xs = np.repeat(self.border_size, num_imgs)
+      flips = np.zeros(num_imgs, dtype=np.bool)
+    else:
+      ys = np.random.randint(0, self.border_size * 2 + 1, size=num_imgs)
+      xs = np.random.randint(0, self.border_size * 2 + 1, size=num_imgs)
+      # also flip the image with 50% probability
+      flips = np.random.randint(2, size=num_imgs) == 0
+    crop_batch(images, target, ys, xs, flips, self.inner_size, sample_major=self.sample_major)
+
+  def _staging(self, slot, num_imgs):
+    images = self._batch_pool.view(slot, 'images', self._images_shape, np.uint8)
+    return images[:num_imgs]
+
+  def _read_images(self, indices, slot):
+    '''Read the given images into the staging buffer of a batch slot.'''
+    staging = self._staging(slot, len(indices))
+    if self._cache is None:
+      self._decode(indices, np.arange(len(indices)), slot)
+      return
+
+    st = time.time()
+    missing = self._cache.fetch(indices, staging)
+    self._add_times({'cache': time.time() - st})
+    if len(missing):
+      self._decode(indices[missing], missing, slot)
+      for pos in missing:
+        self._cache.put(indices[pos], staging[pos])
+
+  def _sources(self, indices):
+    '''Return what _decode_jpegs reads each of the given images from.'''
+    return self._index.paths(indices)
+
+  def _batch_sources(self, epoch, batchnum):
+    indices = self.images[self._batch_images(epoch, batchnum)]
+    if self._cache is not None:
+      # the cache serves these without touching their files
+      indices = indices[~self._cache.contains(indices)]
+    return self._sources(indices)
+
+  def _decode(self, indices, positions, slot):
+    '''Decode the given images into positions of a slot's staging buffer.'''
+    sources = self._sources(indices)
+    if self._pool is None:
+      times = collections.defaultdict(float)
+      _decode_jpegs(sources, self.img_size, out=self._staging(slot, self.batch_size),
+                    positions=positions, times=times)
+      self._add_times(times)
+      return
+
+    # every image has a fixed place in the slot, so the batch layout does not
+    # depend on which worker finishes first
+    tasks = [(slot, positions[chunk], [sources[i] for i in chunk])
+             for chunk in np.array_split(np.arange(len(sources)), self.num_workers) if len(chunk)]
+    for times in self._pool.map(_decode_into_slot, tasks):
+      self._add_times(times)
+
+  def _advance(self):
     self.get_next_index()
 
     self.curr_batch = self.batch_range[self.curr_batch_index]
     if self.curr_batch_index == 0:
       self.curr_epoch += 1
-    
-    epoch = self.curr_epoch
-    batchnum = self.curr_batch
-    names = self.images[self.batches[batchnum]]
-    num_imgs = len(names)
-    labels = np.zeros((1, num_imgs))
-    cropped = np.ndarray((self.get_data_dims(), num_imgs * self.data_mult), dtype=np.uint8)
-    # _load in parallel for training
-    st = time.time()
-    images = []
-    for idx, filename in enumerate(names):
-      jpeg = Image.open(filename)
-      if jpeg.mode != "RGB": jpeg = jpeg.convert("RGB")
-      # starts as rows * cols * rgb, tranpose to rgb * rows * cols
-      img = np.asarray(jpeg, np.uint8).transpose(2, 0, 1)
-      images.append(img)
-
-    self.__trim_borders(images, cropped)
-
-    load_time = time.time() - st
+      if self._cache is not None:
+        self._cache.log_stats()
+      if self.augment is not None:
+        self.augment.log_times()
+    return self.curr_epoch, self.curr_batch
 
-    clabel = []
-    # extract label from the filename
-    for idx, filename in enumerate(names):
-      filename = os.path.basename(filename)
-      synid = filename[1:].split('_')[0]
-      label = self.batch_meta['synid_to_label'][synid]
-      labels[0, idx] = label
+  def _batch_images(self, epoch, batchnum):
+    '''Return which entries of self.images make up a batch.'''
+    return self.batches[batchnum]
 
-    st = time.time()
-    cropped = cropped.astype(np.single)
-    cropped = np.require(cropped, dtype=np.single, requirements='C')
-    cropped -= self.data_mean
+  def _load_batch(self, epoch, batchnum):
+    start = time.time()
+    index = self._batch_images(epoch, batchnum)
+    num_imgs = len(index)
+    slot = self._acquire_slot(epoch, batchnum)
+    try:
+      self._read_images(self.images[index], slot)
 
-    align_time = time.time() - st
+      st = time.time()
+      cropped = self._batch_pool.view(slot, 'data',
+          self.batch_shape(self.get_data_dims(), num_imgs * self.data_mult), self._data_dtype)
+      if self.augment is None:
+        self._trim_borders(self._staging(slot, num_imgs), cropped)
+      else:
+        crops = self.augment(self._staging(slot, num_imgs), epoch, batchnum)
+        assert crops.shape[1:] == self.image_shape, \
+            'Augmentation has to crop the images to %s, got %s' % (self.image_shape, crops.shape[1:])
+        write_batch(crops, cropped, self.sample_major)
+      crop_time = time.time() - st
 
-    labels = np.array(labels)
-    labels = labels.reshape(cropped.shape[1],)
-    labels = np.require(labels, dtype=np.single, requirements='C')
+      st = time.time()
+      if not self.raw_pixels:
+        cropped -= self.data_mean.T if self.sample_major else self.data_mean
+      mean_time = time.time() - st
+    except:
+      self._batch_pool.release(self._batch_slots.pop((epoch, batchnum)))
+      raise
 
-    # util.log("Loaded %d images in %.2f seconds (%.2f _load, %.2f align)",
-    #         num_imgs, time.time() - start, load_time, align_time)
-    # self.data = {'data' : SharedArray(cropped), 'labels' : SharedArray(labels)}
+    labels = np.tile(self.labels[index], self.data_mult)
+    self._add_times({'crop': crop_time, 'mean': mean_time}, time.time() - start)
+    if self.raw_pixels:
+      return BatchData(cropped, labels, epoch, batchnum, self.data_mean)
     return BatchData(cropped, labels, epoch, batchnum)
 
   # Returns the dimensionality of the two data matrices returned by get_next_batch
@@ -229,24 +779,60 @@ class ImageNetDataProvider(ParallelDataProvider):
 
 
 class CifarDataProvider(ParallelDataProvider):
-  def _get_next_batch(self):
+  def __init__(self, data_dir='.', batch_range=None, num_workers=0, cache_mem=0, cache_dir=None,
+               cache_disk=0, **kw):
+    ParallelDataProvider.__init__(self, data_dir, batch_range, **kw)
+    # takes the loading flags of the ImageNet providers, like they take theirs
+    if num_workers > 0:
+      util.log('%s has no JPEGs to decode, ignoring num_workers', self.__class__.__name__)
+    if cache_mem > 0 or cache_disk > 0:
+      util.log('%s does not cache images, ignoring cache_mem and cache_disk', self.__class__.__name__)
+    self._check_augment(self.image_shape)
+
+  def _advance(self):
     self.get_next_index()
     if self.curr_batch_index == 0:
-      random.shuffle(self.batch_range)
       self.curr_epoch += 1
+      # the same order on every run with the same seed
+      random.Random(self.seed + self.curr_epoch).shuffle(self.batch_range)
     self.curr_batch = self.batch_range[self.curr_batch_index]
     # print self.batch_range, self.curr_batch
+    return self.curr_epoch, self.curr_batch
 
-    filename = os.path.join(self.data_dir, 'data_batch_%d' % self.curr_batch)
+  def _load_batch(self, epoch, batchnum):
+    start = time.time()
+    filename = os.path.join(self.data_dir, 'data_batch_%d' % batchnum)
 
-    self.data = util.load(filename)
-    return BatchData(self.data['data'] - self.batch_meta['data_mean'],
-                     np.array(self.data['labels']),
-                     self.curr_epoch,
-                     self.curr_batch)
+    data = util.load(filename)
+    times = {'read': time.time() - start}
+    # the pickles hold one image per column
+    images = data['data']
+    if self.augment is not None:
+      st = time.time()
+      rows = np.ascontiguousarray(images.T).reshape((-1,) + self.image_shape)
+      images = self.augment(rows, epoch, batchnum).reshape((len(rows), -1))
+      if not self.sample_major:
+        images = images.T
+      times['crop'] = time.time() - st
+    elif self.sample_major:
+      images = np.ascontiguousarray(images.T)
+    labels = np.array(data['labels'])
+    mean = self.batch_meta['data_mean']
+    if self.raw_pixels:
+      self._add_times(times, time.time() - start)
+      return BatchData(images, labels, epoch, batchnum, mean)
+    st = time.time()
+    images = images - (mean.T if self.sample_major else mean)
+    times['mean'] = time.time() - st
+    self._add_times(times, time.time() - start)
+    return BatchData(images, labels, epoch, batchnum)
+
+  def _batch_sources(self, epoch, batchnum):
+    return [os.path.join(self.data_dir, 'data_batch_%d' % batchnum)]
 
   def get_batch_filenames(self):
-    return sorted([f for f in os.listdir(self.data_dir) if DataProvider.BATCH_REGEX.match(f)], key=alphanum_key)
+    return sorted([f for f in os.listdir(self.data_dir) if DataProvider.BATCH_REGEX.match(f)],
+                  key=lambda f: int(DataProvider.BATCH_REGEX.match(f).group(1)))
 
   def get_batch_indexes(self):
     names = self.get_batch_filenames()
@@ -258,30 +844,288 @@ class CifarDataProvider(ParallelDataProvider):
 
 
 
+class CifarMemoryDataProvider(CifarDataProvider):
+  '''Serves CIFAR from one memory-mapped uint8 array instead of unpickling a
+  data_batch_N file per batch.
+
+  The first run converts the selected data_batch_N files into
+  cifar-data.npy (one row per image), cifar-labels.npy and cifar-batches.npy
+  (the file each image came from).  Every epoch the images are reshuffled
+  individually and served images_per_batch at a time, mean subtracted into
+  reused float32 buffers.'''
+  shard_batches = False
+  DATA_FILE = 'cifar-data.npy'
+  LABEL_FILE = 'cifar-labels.npy'
+  SOURCE_FILE = 'cifar-batches.npy'
+
+  def __init__(self, data_dir, batch_range=None, images_per_batch=10000, **kw):
+    CifarDataProvider.__init__(self, data_dir, batch_range, **kw)
+    self.images_per_batch = images_per_batch
+
+    self._data, self._labels, sources = self._open_arrays()
+    self.images = np.nonzero(np.in1d(sources, self.batch_range))[0]
+    self.batch_range = range(util.divup(len(self.shard(self.images)), self.images_per_batch))
+    util.log('Serving %d CIFAR images in %d batches', len(self.images), len(self.batch_range))
+
+    self.data_mean = np.require(self.batch_meta['data_mean'], dtype=np.single).reshape((-1, 1))
+    self._data_dtype = np.uint8 if self.raw_pixels else np.single
+    # 'rows' holds the gathered uint8 images of a batch, 'data' the batch
+    self._init_batch_pool({'rows': self._data.shape[1] * self.images_per_batch,
+                           'data': self._data.shape[1] * self.images_per_batch *
+                                   np.dtype(self._data_dtype).itemsize,
+                           'labels': self.images_per_batch * 4})
+
+  def _batch_sources(self, epoch, batchnum):
+    # the images are gathered from all over the mapped array
+    return None
+
+  def _open_arrays(self):
+    paths = [os.path.join(self.data_dir, f) for f in [self.DATA_FILE, self.LABEL_FILE, self.SOURCE_FILE]]
+    if not all(os.path.exists(p) for p in paths):
+      self._convert(paths)
+    return [np.load(p, mmap_mode='r') for p in paths]
+
+  def _convert(self, paths):
+    util.log('Converting CIFAR batches in %s to %s', self.data_dir, self.DATA_FILE)
+    data, labels, sources = [], [], []
+    for batchnum in sorted(self.get_batch_indexes()):
+      d = util.load(os.path.join(self.data_dir, 'data_batch_%d' % batchnum))
+      # batches hold one image per column
+      data.append(np.require(d['data'].T, dtype=np.uint8, requirements='C'))
+      labels.append(np.array(d['labels'], dtype=np.single))
+      sources.append(np.repeat(batchnum, len(d['labels'])).astype(np.int32))
+
+    for path, array in zip(paths, [np.concatenate(data), np.concatenate(labels), np.concatenate(sources)]):
+      np.save(path, array)
+
+  def _advance(self):
+    self.get_next_index()
+    if self.curr_batch_index == 0:
+      self.curr_epoch += 1
+      if self.augment is not None:
+        self.augment.log_times()
+    self.curr_batch = self.batch_range[self.curr_batch_index]
+    return self.curr_epoch, self.curr_batch
+
+  def _epoch_order(self, epoch):
+    # derived from the epoch rather than stored, so readers still working on
+    # the previous epoch see the same order; every rank draws the same
+    # permutation and keeps its own shard of it
+    return self.shard(np.random.RandomState((self.seed + epoch) % 2 ** 32).permutation(self.images))
+
+  def _load_batch(self, epoch, batchnum):
+    start = time.time()
+    times = {}
+    index = np.array_split(self._epoch_order(epoch), len(self.batch_range))[batchnum]
+    num_imgs = len(index)
+    slot = self._acquire_slot(epoch, batchnum)
+    data = self._batch_pool.view(slot, 'data', self.batch_shape(self._data.shape[1], num_imgs),
+                                 self._data_dtype)
+    labels = self._batch_pool.view(slot, 'labels', (num_imgs,), np.single)
+
+    labels[:] = self._labels[index]
+    # the array holds one image per row, so a raw sample major batch is a
+    # straight gather of rows
+    if self.sample_major and self.raw_pixels and self.augment is None:
+      np.take(self._data, index, axis=0, out=data)
+      times['read'] = time.time() - start
+    else:
+      rows = self._batch_pool.view(slot, 'rows', (num_imgs, self._data.shape[1]), np.uint8)
+      np.take(self._data, index, axis=0, out=rows)
+      times['read'] = time.time() - start
+      if self.augment is not None:
+        st = time.time()
+        images = self.augment(rows.reshape((num_imgs,) + self.image_shape), epoch, batchnum)
+        assert images.shape[1:] == self.image_shape, \
+            'Augmentation may not change the image shape, got %s' % (images.shape[1:],)
+        rows = images.reshape((num_imgs, -1))
+        times['crop'] = time.time() - st
+
+      st = time.time()
+      if not self.sample_major:
+        rows = rows.T
+      if self.raw_pixels:
+        data[:] = rows
+      else:
+        np.subtract(rows, self.data_mean.T if self.sample_major else self.data_mean, out=data)
+      times['mean'] = time.time() - st
+
+    self._add_times(times, time.time() - start)
+    if self.raw_pixels:
+      return BatchData(data, labels, epoch, batchnum, self.data_mean)
+    return BatchData(data, labels, epoch, batchnum)
+
+
+class ShardedImageNetDataProvider(ImageNetDataProvider):
+  '''Reads pre-resized images from the packed shards written by
+  `python -m striate.shard`, instead of decoding JPEGs.'''
+  # a record is read straight into the batch, so there is nothing to decode
+  # and a cache would only copy it
+  decodes_jpegs = False
+  caches_images = False
+
+  def _list_images(self, category_range):
+    self._shards = ShardReader(self.data_dir)
+    assert self._shards.img_size == self.img_size, \
+        'Shards hold %d pixel images, expected %d' % (self._shards.img_size, self.img_size)
+
+    selected = np.in1d(self._shards.positions, self.batch_range)
+    if category_range is not None:
+      selected &= np.in1d(self._shards.labels, category_range)
+
+    self.images = np.nonzero(selected)[0]
+    self.labels = self._shards.labels[self.images].astype(np.single)
+
+  def _read_images(self, records, slot):
+    st = time.time()
+    self._shards.gather(records, out=self._staging(slot, len(records)))
+    self._add_times({'read': time.time() - st})
+
+  def _sources(self, records):
+    return self._shards.extents(records)
+
+
+class TarImageNetDataProvider(ImageNetDataProvider):
+  '''Streams JPEGs straight out of one tar file per category (nSYNID.tar),
+  indexed once by `python -m striate.image_index --tars`.
+
+  Every epoch the tars are visited in a new random order and their members
+  read front to back, so the disk sees long sequential runs; the stream is
+  then mixed through a shuffle buffer of shuffle_size images.'''
+  def __init__(self, data_dir, batch_range=None, shuffle_size=10000, **kw):
+    self.shuffle_size = shuffle_size
+    self._orders = {}
+    self._order_lock = threading.Lock()
+    ImageNetDataProvider.__init__(self, data_dir, batch_range, **kw)
+    # batches follow the stream, so they are served in order
+    self.batch_range = range(len(self.batches))
+
+  def _list_images(self, category_range):
+    self._index = self._open_index(TarIndex)
+    self.images = self._index.select(category_range, self.batch_range)
+    self.labels = self._index.labels[self.images].astype(np.single)
+
+  def _sources(self, indices):
+    return self._index.members(indices)
+
+  def _epoch_order(self, epoch):
+    '''The order this rank reads self.images in during an epoch.'''
+    with self._order_lock:
+      if epoch not in self._orders:
+        rng = np.random.RandomState((self.seed + epoch) % 2 ** 32)
+        # images are sorted by category, and by offset within their tar
+        labels = self._index.labels[self.images]
+        tars = np.unique(labels)
+        runs = [np.nonzero(labels == t)[0] for t in rng.permutation(tars)]
+        stream = np.concatenate(runs) if runs else np.zeros(0, dtype=np.int64)
+        self._orders[epoch] = self.shard(self._shuffle_stream(stream, rng))
+        # readers are at most one epoch apart
+        for e in self._orders.keys():
+          if e < epoch - 1:
+            del self._orders[e]
+      return self._orders[epoch]
+
+  def _shuffle_stream(self, stream, rng):
+    '''Pass stream through a buffer of shuffle_size items, emitting a random
+    one of them as each new item arrives.'''
+    size = min(self.shuffle_size, len(stream))
+    if size <= 1:
+      return stream
+    buf = list(stream[:size])
+    picks = rng.randint(0, size, size=len(stream) - size)
+    out = []
+    for item, pick in zip(stream[size:], picks):
+      out.append(buf[pick])
+      buf[pick] = item
+    rng.shuffle(buf)
+    out.extend(buf)
+    return np.array(out, dtype=stream.dtype)
+
+  def _batch_images(self, epoch, batchnum):
+    return np.array_split(self._epoch_order(epoch), len(self.batches))[batchnum]
+
+
 class ImageNetCateGroupDataProvider(ImageNetDataProvider):
   TOTAL_CATEGORY = 1000
-  def __init__(self, data_dir, batch_range, num_group, batch_size=128):
-    ImageNetDataProvider.__init__(self, data_dir, batch_range)
+  def __init__(self, data_dir, batch_range, num_group, batch_size=128, **kw):
+    ImageNetDataProvider.__init__(self, data_dir, batch_range, batch_size=batch_size, **kw)
     self.num_group = num_group
 
-  def _get_next_batch(self):
-    data = ImageNetDataProvider._get_next_batch(self)
+  def _load_batch(self, epoch, batchnum):
+    data = ImageNetDataProvider._load_batch(self, epoch, batchnum)
     labels = data.labels / (ImageNetCateGroupDataProvider.TOTAL_CATEGORY / self.num_group)
     labels = labels.astype(np.int).astype(np.float)
-    return BatchData(data.data, labels, data.epoch, data.batchnum)
+    return data._replace(labels=labels)
 
 
 
+class SyntheticDataProvider(DataProvider):
+  '''Serves the same batch of random images over and over, to time the
+  network without any disk or decoding in the way.
+
+  The batch is filled once when the provider is built, so handing out a
+  batch costs nothing and allocates nothing.  The loading options of the
+  other providers are accepted and ignored, so the same flags work.'''
+  LOADING_PARAMS = ['prefetch', 'num_readers', 'num_workers', 'multiview', 'readahead',
+                    'cache_mem', 'cache_dir', 'cache_disk', 'store']
+
+  def __init__(self, data_dir='.', batch_range=None, image_size=224, image_color=3,
+               num_classes=1000, images_per_batch=1024, num_batches=None, **kw):
+    for name in SyntheticDataProvider.LOADING_PARAMS:
+      kw.pop(name, None)
+    # num_batches, if given, wins over batch_range
+    self.num_batches = num_batches or 10
+    if num_batches is not None:
+      batch_range = range(num_batches)
+    DataProvider.__init__(self, data_dir, batch_range, **kw)
+    self._image_shape = (image_color, image_size, image_size)
+    self.num_classes = num_classes
+    self.images_per_batch = images_per_batch
+
+    rng = np.random.RandomState(self.seed)
+    dtype = np.uint8 if self.raw_pixels else np.single
+    shape = self.batch_shape(self.get_data_dims(), images_per_batch)
+    # random bytes straight into uint8, with no int64 array on the way
+    self._data = np.frombuffer(rng.bytes(int(np.prod(shape))), dtype=np.uint8).reshape(shape).astype(dtype)
+    self._labels = rng.randint(0, num_classes, size=images_per_batch).astype(np.single)
+    self.data_mean = np.zeros((self.get_data_dims(), 1), dtype=np.single)
+    util.log('Synthetic batches of %d %s images in %d classes', images_per_batch,
+             'x'.join(str(d) for d in self._image_shape), num_classes)
+
+  def get_batch_indexes(self):
+    return range(self.num_batches)
+
+  def _advance(self):
+    self.get_next_index()
+    if self.curr_batch_index == 0:
+      self.curr_epoch += 1
+    self.curr_batch = self.batch_range[self.curr_batch_index]
+    return self.curr_epoch, self.curr_batch
+
+  def _load_batch(self, epoch, batchnum):
+    if self.raw_pixels:
+      return BatchData(self._data, self._labels, epoch, batchnum, self.data_mean)
+    return BatchData(self._data, self._labels, epoch, batchnum)
+
+  def get_data_dims(self, idx=0):
+    return int(np.prod(self._image_shape)) if idx == 0 else 1
+
+  @property
+  def image_shape(self):
+    return self._image_shape
+
+
 
 DataProvider.register_data_provider('cifar10', CifarDataProvider)
+DataProvider.register_data_provider('cifar10mem', CifarMemoryDataProvider)
 DataProvider.register_data_provider('imagenet', ImageNetDataProvider)
 DataProvider.register_data_provider('imagenetcategroup', ImageNetCateGroupDataProvider)
+DataProvider.register_data_provider('imagenetshard', ShardedImageNetDataProvider)
+DataProvider.register_data_provider('imagenettar', TarImageNetDataProvider)
+DataProvider.register_data_provider('synthetic', SyntheticDataProvider)
 
 
 if __name__ == "__main__":
-  data_dir = '/ssd/nn-data/imagenet/'
-  dp = ImageNetDataProvider(data_dir, range(1300))
-  # data_dir = '/hdfs/cifar/data/cifar-10-python/'
-  # dp = DataProvider(data_dir, [1, 2, 3, 4, 5 ])
-  for i in range(11000):
-    data = dp.get_next_batch()
+  # python -m striate.data is the same as the striate command
+  from striate.bench import main
+  main()
@@ -1,6 +1,6 @@
 from pycuda import cumath, gpuarray, driver as cuda
 from pycuda.gpuarray import GPUArray
-from striate import util
+from striate import checkpoint, util
 from striate.cuda_kernel import gpu_copy_to, transpose
 from striate.layer import ConvLayer, NeuronLayer, MaxPoolLayer, \
   ResponseNormLayer, FCLayer, SoftmaxLayer, TRAIN, WeightedLayer, TEST, \
@@ -27,6 +27,10 @@ class FastNet(object):
 
     self.numConv = 0
     
+    if isinstance(init_model, basestring):
+      # a checkpoint file or directory
+      init_model = checkpoint.load(init_model)
+
     if 'model_state' in init_model:
       # Loading from a checkpoint
       add_layers(FastNetBuilder(), self, init_model['model_state']['layers'])
@@ -210,20 +214,68 @@ class FastNet(object):
     self.cost += cost
     self.correct += correct
 
+    self._save_layer_outputs()
+
+    if train == TRAIN:
+      self.bprop(self.data, self.label, self.output)
+      self.update()
+
+  def _save_layer_outputs(self):
     if self.save_layers is not None:
       it = [(i, self.layers[i].name) for i in range(len(self.layers)) if self.layers[i].name in self.save_layers]
       outputs = [transpose(o).get() for o in self.outputs]
       label = self.label.get()
       self.save_output.extend([(label[i, 0], dict([(name, outputs[j][i,:]) for j, name in it])) for i in range(self.batchSize)])
 
-    if train == TRAIN:
-      self.bprop(self.data, self.label, self.output)
-      self.update()
+  def test_multiview(self, views, label, average_outputs=()):
+    '''Score one test minibatch from several views of the same images.
+
+    `views` yields one input per view; the softmax outputs are averaged over
+    the views before the cost is computed, so every image counts once.  The
+    outputs of the save layers and of average_outputs (indices into
+    self.outputs) are averaged too and left in self.outputs, so whatever is
+    captured from them afterwards describes all the views.'''
+    keep = set(i % len(self.outputs) for i in average_outputs)
+    if self.save_layers is not None:
+      keep.update(i for i, l in enumerate(self.layers) if l.name in self.save_layers)
+    sums = {}
+    probs = None
+    num_views = 0
+    for data in views:
+      self.prepare_for_train(data, label)
+      self.fprop(self.data, self.output, TEST)
+      if probs is None:
+        probs = gpuarray.empty_like(self.output)
+        gpu_copy_to(self.output, probs)
+      else:
+        probs += self.output
+      for i in keep:
+        if i in sums:
+          sums[i] += self.outputs[i]
+        else:
+          sums[i] = self.outputs[i].copy()
+      num_views += 1
+
+    probs *= 1.0 / num_views
+    for i, total in sums.items():
+      total *= 1.0 / num_views
+      gpu_copy_to(total, self.outputs[i])
+    # prepare_for_train counted the images once per view
+    self.numCase -= (num_views - 1) * self.data.shape[1]
+    cost, correct = self.get_cost(self.label, probs)
+    self.cost += cost
+    self.correct += correct
+    self._save_layer_outputs()
 
-  def get_dumped_layers(self):
+  def get_dumped_layers(self, hosts=None):
+    '''hosts, if given, holds a dict of reusable host arrays for every layer
+    (see WeightedLayer.dump).'''
     layers = []
-    for l in self.layers:
-      layers.append(l.dump())
+    for i, l in enumerate(self.layers):
+      if hosts is not None and isinstance(l, WeightedLayer):
+        layers.append(l.dump(hosts[i]))
+      else:
+        layers.append(l.dump())
 
     return layers
 
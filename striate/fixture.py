@@ -0,0 +1,96 @@
+'''Write small synthetic datasets in the layouts the data providers read, so
+the loaders can be tested and benchmarked without the real data.
+
+An ImageNet fixture is a tree of nSYNID directories of random JPEGs with the
+batches.meta that scripts/build-synid-map.py would write for it and the
+image-mean.pickle of its images; a CIFAR fixture is a set of data_batch_N
+pickles with its batches.meta.
+
+  python -m striate.fixture --out_dir /tmp/imagenet-fixture --kind imagenet \
+      --num_categories 10 --images_per_category 50 --min_size 200 --max_size 500
+'''
+
+from PIL import Image
+from striate import data, preprocess, util
+import argparse
+import numpy as np
+import os
+
+
+def random_image(rng, rows, cols):
+  '''A smooth random colour field with some noise on top, which compresses
+  and decodes more like a photo than pure noise does.'''
+  coarse = rng.randint(0, 256, size=(4, 4, 3)).astype(np.uint8)
+  img = np.asarray(Image.fromarray(coarse).resize((cols, rows), Image.BILINEAR), dtype=np.int16)
+  img += rng.randint(-16, 17, size=img.shape).astype(np.int16)
+  return Image.fromarray(np.clip(img, 0, 255).astype(np.uint8))
+
+
+def make_imagenet(out_dir, num_categories=10, images_per_category=20, min_size=256, max_size=256,
+                  img_size=256, seed=0):
+  '''Write num_categories directories of images_per_category JPEGs whose
+  sides are drawn from [min_size, max_size], with batches.meta and the
+  mean of the images scaled to img_size.'''
+  rng = np.random.RandomState(seed)
+  synids = ['%08d' % (1440764 + i) for i in range(num_categories)]
+  mean = np.zeros((3, img_size, img_size), dtype=np.float64)
+  for synid in synids:
+    d = os.path.join(out_dir, 'n' + synid)
+    if not os.path.exists(d):
+      os.makedirs(d)
+    for i in range(images_per_category):
+      rows, cols = rng.randint(min_size, max_size + 1, size=2)
+      filename = os.path.join(d, 'n%s_%d.jpg' % (synid, i))
+      random_image(rng, rows, cols).save(filename, quality=90)
+      mean += data._decode_jpegs([filename], img_size)[0]
+
+  meta = preprocess.synid_meta(synids, dict((s, 'synset %s' % s) for s in synids))
+  preprocess.write_meta(out_dir, meta, mean / (num_categories * images_per_category))
+  util.log('Wrote %d images in %d categories to %s', num_categories * images_per_category,
+           num_categories, out_dir)
+
+
+def make_cifar(out_dir, num_batches=6, images_per_batch=1000, num_classes=10, seed=0):
+  '''Write data_batch_1 .. data_batch_N with one 32x32 image per column and
+  a batches.meta holding their mean.'''
+  rng = np.random.RandomState(seed)
+  if not os.path.exists(out_dir):
+    os.makedirs(out_dir)
+
+  dims = 3 * 32 * 32
+  total = np.zeros((dims, 1), dtype=np.float64)
+  for batchnum in range(1, num_batches + 1):
+    images = [np.asarray(random_image(rng, 32, 32)).transpose(2, 0, 1).reshape(-1)
+              for i in range(images_per_batch)]
+    batch = np.array(images, dtype=np.uint8).T
+    labels = list(rng.randint(0, num_classes, size=images_per_batch))
+    util.save({'data': batch, 'labels': labels, 'batch_label': 'batch %d' % batchnum},
+              os.path.join(out_dir, 'data_batch_%d' % batchnum))
+    total += batch.sum(axis=1, keepdims=True)
+
+  meta = {'label_names': ['class %d' % i for i in range(num_classes)],
+          'num_cases_per_batch': images_per_batch,
+          'num_vis': dims,
+          'data_mean': (total / (num_batches * images_per_batch)).astype(np.single)}
+  util.save(meta, os.path.join(out_dir, 'batches.meta'))
+  util.log('Wrote %d batches of %d images to %s', num_batches, images_per_batch, out_dir)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--out_dir', help = 'Where to write the dataset', required = True)
+  parser.add_argument('--kind', help = 'Which layout to write', choices = ['imagenet', 'cifar'], default = 'imagenet')
+  parser.add_argument('--num_categories', help = 'ImageNet categories', default = 10, type = int)
+  parser.add_argument('--images_per_category', help = 'JPEGs per ImageNet category', default = 20, type = int)
+  parser.add_argument('--min_size', help = 'Smallest side of an ImageNet JPEG', default = 256, type = int)
+  parser.add_argument('--max_size', help = 'Largest side of an ImageNet JPEG', default = 256, type = int)
+  parser.add_argument('--num_batches', help = 'CIFAR batch files', default = 6, type = int)
+  parser.add_argument('--images_per_batch', help = 'Images per CIFAR batch file', default = 1000, type = int)
+  parser.add_argument('--seed', help = 'Random seed', default = 0, type = int)
+  args = parser.parse_args()
+
+  if args.kind == 'imagenet':
+    make_imagenet(args.out_dir, args.num_categories, args.images_per_category,
+                  args.min_size, args.max_size, seed=args.seed)
+  else:
+    make_cifar(args.out_dir, args.num_batches, args.images_per_batch, seed=args.seed)
@@ -0,0 +1,196 @@
+'''A compact, memory-mappable index of a synset tree (one n* directory of
+JPEGs per category).
+
+The index lives in a directory of .npy files:
+
+  path_table.npy          uint8, every image path relative to the data
+                          directory, concatenated
+  path_offsets.npy        int64, image i's path is
+                          path_table[off[i]:off[i + 1]]
+  labels.npy              int32 label of every image
+  category_offsets.npy    int64, the images of category c are
+                          [off[c], off[c + 1]); images are sorted by label
+
+Images keep the order glob lists them in inside their directory, so an
+image's position in its category (what batch_range selects on) does not
+change when the tree is indexed.
+
+A TarIndex does the same for a tree packed as one tar file per category
+(nSYNID.tar), recording where every JPEG member's bytes start in its tar
+(tars.index/tar_names.npy, member_offsets.npy, member_sizes.npy, labels.npy
+and category_offsets.npy), so that an image is read with one seek.  Build
+either index once with
+
+  python -m striate.image_index --data_dir /ssd/nn-data/imagenet/ [--tars]
+'''
+
+from os.path import basename
+from striate import util
+import argparse
+import collections
+import glob
+import numpy as np
+import os
+import tarfile
+
+# Where a JPEG is inside a tar file; picklable, so it can be handed to the
+# decode worker processes.
+TarMember = collections.namedtuple('TarMember', ['path', 'offset', 'size'])
+
+def read_member(member):
+  with open(member.path, 'rb') as f:
+    f.seek(member.offset)
+    return f.read(member.size)
+
+
+class CategoryIndex(object):
+  '''Images sorted by label, stored as .npy files in INDEX_DIR.  Subclasses
+  list their arrays in ARRAYS, with labels and category_offsets last: save()
+  writes category_offsets only once the rest is there.'''
+  INDEX_DIR = None
+  ARRAYS = ['labels', 'category_offsets']
+
+  def __init__(self, data_dir, *arrays):
+    self.data_dir = data_dir
+    for name, array in zip(self.ARRAYS, arrays):
+      setattr(self, name, array)
+
+  @property
+  def num_images(self):
+    return len(self.labels)
+
+  @property
+  def num_categories(self):
+    return len(self.category_offsets) - 1
+
+  @property
+  def positions(self):
+    '''The index of every image within its category.'''
+    return np.arange(self.num_images) - self.category_offsets[self.labels]
+
+  def select(self, category_range=None, batch_range=None):
+    '''Return the indices of the images in the given categories whose
+    position within their category is in batch_range.'''
+    if category_range is None:
+      category_range = range(self.num_categories)
+    offsets = self.category_offsets
+    ranges = [np.arange(offsets[c], offsets[c + 1]) for c in category_range]
+    indices = np.concatenate(ranges) if ranges else np.zeros(0, dtype=np.int64)
+
+    if batch_range is not None:
+      positions = indices - offsets[self.labels[indices]]
+      indices = indices[np.in1d(positions, batch_range)]
+    return indices
+
+  def save(self, index_dir):
+    if not os.path.exists(index_dir):
+      os.makedirs(index_dir)
+    for name in self.ARRAYS:
+      np.save(os.path.join(index_dir, name + '.npy'), getattr(self, name))
+
+  @classmethod
+  def load(cls, data_dir, index_dir=None):
+    if index_dir is None:
+      index_dir = os.path.join(data_dir, cls.INDEX_DIR)
+    arrays = [np.load(os.path.join(index_dir, name + '.npy'), mmap_mode='r') for name in cls.ARRAYS]
+    return cls(data_dir, *arrays)
+
+  @staticmethod
+  def _label_arrays(category_offsets):
+    '''Return the labels and category_offsets arrays of images sorted by
+    label, given the offset at which each category starts.'''
+    category_offsets = np.array(category_offsets, dtype=np.int64)
+    labels = np.repeat(np.arange(len(category_offsets) - 1, dtype=np.int32),
+                       np.diff(category_offsets))
+    return labels, category_offsets
+
+  @classmethod
+  def open(cls, data_dir, batch_meta):
+    '''Load the index of data_dir, building and saving it if it is missing.'''
+    index_dir = os.path.join(data_dir, cls.INDEX_DIR)
+    if os.path.exists(os.path.join(index_dir, cls.ARRAYS[-1] + '.npy')):
+      return cls.load(data_dir, index_dir)
+
+    util.log('No %s in %s, scanning the directory tree', cls.INDEX_DIR, data_dir)
+    index = cls.build(data_dir, batch_meta)
+    try:
+      index.save(index_dir)
+    except (IOError, OSError), e:
+      util.log('Could not save the image index: %s', e)
+    return index
+
+
+class ImageIndex(CategoryIndex):
+  INDEX_DIR = 'images.index'
+  ARRAYS = ['path_table', 'path_offsets', 'labels', 'category_offsets']
+
+  def path(self, i):
+    rel = self.path_table[self.path_offsets[i]:self.path_offsets[i + 1]].tostring()
+    return os.path.join(self.data_dir, rel)
+
+  def paths(self, indices):
+    return np.array([self.path(i) for i in indices])
+
+  @staticmethod
+  def build(data_dir, batch_meta):
+    '''Walk the synset tree in label order.'''
+    rel_paths = []
+    category_offsets = [0]
+    for synid in batch_meta['label_to_synid']:
+      d = os.path.join(data_dir, 'n' + synid)
+      rel_paths.extend(os.path.join(basename(d), basename(f)) for f in glob.glob(d + '/*.jpg'))
+      category_offsets.append(len(rel_paths))
+
+    lengths = np.array([len(p) for p in rel_paths], dtype=np.int64)
+    path_offsets = np.zeros(len(rel_paths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=path_offsets[1:])
+    path_table = np.fromstring(''.join(rel_paths), dtype=np.uint8)
+    return ImageIndex(data_dir, path_table, path_offsets, *CategoryIndex._label_arrays(category_offsets))
+
+
+class TarIndex(CategoryIndex):
+  INDEX_DIR = 'tars.index'
+  ARRAYS = ['tar_names', 'member_offsets', 'member_sizes', 'labels', 'category_offsets']
+
+  def member(self, i):
+    tar = self.tar_names[self.labels[i]]
+    return TarMember(os.path.join(self.data_dir, tar), int(self.member_offsets[i]), int(self.member_sizes[i]))
+
+  def members(self, indices):
+    return [self.member(i) for i in indices]
+
+  @staticmethod
+  def build(data_dir, batch_meta):
+    '''Read the JPEG members of every category's tar in archive order; a
+    category without a tar is left empty.'''
+    tar_names = ['n%s.tar' % synid for synid in batch_meta['label_to_synid']]
+    offsets, sizes = [], []
+    category_offsets = [0]
+    for name in tar_names:
+      path = os.path.join(data_dir, name)
+      if os.path.exists(path):
+        with tarfile.open(path) as tar:
+          for m in tar:
+            if m.isfile() and m.name.lower().endswith(('.jpg', '.jpeg')):
+              offsets.append(m.offset_data)
+              sizes.append(m.size)
+      category_offsets.append(len(offsets))
+
+    return TarIndex(data_dir, np.array(tar_names), np.array(offsets, dtype=np.int64),
+                    np.array(sizes, dtype=np.int64), *CategoryIndex._label_arrays(category_offsets))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--data_dir', help = 'The synset tree to index', required = True)
+  parser.add_argument('--tars', help = 'Index one tar file per category instead of directories',
+                      default = False, action = 'store_true')
+  parser.add_argument('--index_dir', help = 'Where to write the index (default: DATA_DIR/%s or DATA_DIR/%s)' %
+                      (ImageIndex.INDEX_DIR, TarIndex.INDEX_DIR))
+  args = parser.parse_args()
+
+  cls = TarIndex if args.tars else ImageIndex
+  batch_meta = util.load(os.path.join(args.data_dir, 'batches.meta'))
+  index = cls.build(args.data_dir, batch_meta)
+  index.save(args.index_dir or os.path.join(args.data_dir, cls.INDEX_DIR))
+  util.log('Indexed %d images in %d categories', index.num_images, index.num_categories)
@@ -42,6 +42,13 @@ class Layer(object):
         d[att] = getattr(self, att)
     return d
 
+def _to_host(ary, host, name):
+  if host is None:
+    return ary.get()
+  if name not in host or host[name].shape != ary.shape or host[name].dtype != ary.dtype:
+    host[name] = cuda.pagelocked_empty(ary.shape, ary.dtype)
+  return ary.get(ary=host[name])
+
 def randn(shape, dtype):
   np.random.seed(0)
   #return np.require(np.random.randn(*shape), dtype=dtype, requirements='C')
@@ -135,14 +142,14 @@ class WeightedLayer(Layer):
     return self.name, (w, wi, b, bi)
 
 
-  def dump(self):
+  def dump(self, host=None):
+    '''If host is given, the arrays are copied into the page-locked arrays it
+    holds under the same names, allocated on first use, instead of into new
+    ones; a checkpoint writer keeps one host dict per layer across saves.'''
     d = Layer.dump(self)
-    d['weight'] = self.weight.get()
-    d['bias'] = self.bias.get()
-    if 'weightIncr' in d:
-      d['weightIncr'] = self.weightIncr.get()
-    if 'biasIncr' in d:
-      d['biasIncr'] = self.biasIncr.get()
+    for name in ['weight', 'bias', 'weightIncr', 'biasIncr']:
+      if name in d:
+        d[name] = _to_host(getattr(self, name), host, name)
     del d['weightGrad'], d['biasGrad']
     return d
 
@@ -170,8 +177,8 @@ class ConvLayer(WeightedLayer):
         bias, weightIncr, biasIncr, self.weightShape, self.biasShape)
 
 
-  def dump(self):
-    d = WeightedLayer.dump(self)
+  def dump(self, host=None):
+    d = WeightedLayer.dump(self, host)
     if 'tmp' in d:
       del d['tmp']
     return d
@@ -341,8 +348,8 @@ class FCLayer(WeightedLayer):
     util.log('%s dropRate: %s', self.name, self.dropRate)
 
 
-  def dump(self):
-    d = WeightedLayer.dump(self)
+  def dump(self, host=None):
+    d = WeightedLayer.dump(self, host)
     '''
     weight = self.weight.get()
     if weight.shape[1] > 96 * 26 * 26:
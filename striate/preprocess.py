@@ -0,0 +1,118 @@
+'''Prepare a synset tree (one nSYNID directory of JPEGs per category) for
+ImageNetDataProvider in one pass over the images:
+
+  batches.meta        label_names, synid_to_label and label_to_synid, as
+                      scripts/build-synid-map.py writes them
+  image-mean.pickle   the per pixel mean of the images, scaled and centre
+                      cropped to img_size x img_size as the provider does
+
+and, with --resize_dir, a copy of the tree with every image already scaled
+to img_size x img_size.  The images are spread over worker processes that
+each sum their share into one accumulator, so the dataset is never held in
+memory.
+
+  python -m striate.preprocess --data_dir /ssd/nn-data/imagenet-raw/ \
+      --resize_dir /ssd/nn-data/imagenet/ --num_workers 16
+'''
+
+from os.path import basename, dirname
+from striate import data, util
+from striate.image_index import ImageIndex
+import argparse
+import glob
+import multiprocessing
+import numpy as np
+import os
+import re
+
+SYNSET_NAMES = os.path.join(dirname(dirname(os.path.abspath(__file__))), 'scripts', 'fall11_synsets.txt')
+
+
+def synid_meta(synids, names={}):
+  '''The batches.meta of the categories synids, in label order.'''
+  return {'label_names': [names.get(s, s) for s in synids],
+          'synid_to_label': dict((s, i) for i, s in enumerate(synids)),
+          'label_to_synid': synids}
+
+
+def build_meta(data_dir, synset_names=SYNSET_NAMES):
+  synids = sorted(basename(d)[1:] for d in glob.glob(os.path.join(data_dir, 'n*')) if os.path.isdir(d))
+  names = {}
+  if os.path.exists(synset_names):
+    for line in open(synset_names).read().split('\n'):
+      if line:
+        synid, name = re.split(' ', line, maxsplit=1)
+        names[synid] = name.split(',')[0]
+  return synid_meta(synids, names)
+
+
+def write_meta(out_dir, meta, mean):
+  '''Write batches.meta and the (3, rows, cols) image mean to out_dir.'''
+  util.save(meta, os.path.join(out_dir, 'batches.meta'))
+  util.save({'data': mean.reshape((1, -1)).astype(np.single)},
+            os.path.join(out_dir, 'image-mean.pickle'))
+
+
+def _process_chunk(args):
+  '''Sum a chunk of images scaled to img_size, writing each one under
+  resize_dir if it is given, and return the sum and the image count.'''
+  data_dir, rel_paths, img_size, resize_dir = args
+  total = np.zeros((3, img_size, img_size), dtype=np.float64)
+  for rel in rel_paths:
+    jpeg = data._open_image(os.path.join(data_dir, rel), img_size)
+    total += np.asarray(jpeg, np.uint8).transpose(2, 0, 1)
+    if resize_dir is not None:
+      jpeg.save(os.path.join(resize_dir, rel), quality=90)
+  return total, len(rel_paths)
+
+
+def preprocess(data_dir, out_dir=None, resize_dir=None, img_size=256, num_workers=1, chunk_size=64,
+               synset_names=SYNSET_NAMES):
+  out_dir = out_dir or resize_dir or data_dir
+  meta = build_meta(data_dir, synset_names)
+  index = ImageIndex.build(data_dir, meta)
+  rel_paths = [os.path.relpath(index.path(i), data_dir) for i in range(index.num_images)]
+  if resize_dir is not None:
+    for synid in meta['label_to_synid']:
+      if not os.path.exists(os.path.join(resize_dir, 'n' + synid)):
+        os.makedirs(os.path.join(resize_dir, 'n' + synid))
+  util.log('Found %d images in %d categories', len(rel_paths), len(meta['label_to_synid']))
+
+  chunks = [(data_dir, rel_paths[i:i + chunk_size], img_size, resize_dir)
+            for i in range(0, len(rel_paths), chunk_size)]
+  total = np.zeros((3, img_size, img_size), dtype=np.float64)
+  count = 0
+  pool = multiprocessing.Pool(num_workers) if num_workers > 1 else None
+  try:
+    results = pool.imap_unordered(_process_chunk, chunks) if pool else (_process_chunk(c) for c in chunks)
+    for chunk_total, chunk_count in results:
+      total += chunk_total
+      count += chunk_count
+      if count % (chunk_size * 100) < chunk_count:
+        util.log('Processed %d of %d images', count, len(rel_paths))
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+
+  if not os.path.exists(out_dir):
+    os.makedirs(out_dir)
+  mean = total / max(count, 1)
+  write_meta(out_dir, meta, mean)
+  util.log('Wrote batches.meta and image-mean.pickle for %d images to %s', count, out_dir)
+  return meta, mean
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--data_dir', help = 'The synset tree to read', required = True)
+  parser.add_argument('--out_dir', help = 'Where to write batches.meta and image-mean.pickle '
+                      '(default: RESIZE_DIR, or else DATA_DIR)')
+  parser.add_argument('--resize_dir', help = 'Write a copy of the tree scaled to IMG_SIZE here')
+  parser.add_argument('--img_size', help = 'The side of the scaled images', default = 256, type = int)
+  parser.add_argument('--num_workers', help = 'Number of worker processes', default = multiprocessing.cpu_count(), type = int)
+  parser.add_argument('--synset_names', help = 'synset id to name list', default = SYNSET_NAMES)
+  args = parser.parse_args()
+
+  preprocess(args.data_dir, args.out_dir, args.resize_dir, args.img_size, args.num_workers,
+             synset_names=args.synset_names)
@@ -0,0 +1,127 @@
+'''Tell the OS which files the next batches will read, while the current one
+is still decoding.
+
+A Readahead takes the files of an upcoming batch (paths, or (path, offset,
+size) extents such as a TarMember) and, on a background thread, asks the
+kernel to start reading them into the page cache with
+posix_fadvise(POSIX_FADV_WILLNEED).  Where that call is not available the
+bytes are read and thrown away instead, which warms the cache the same way.
+
+At most budget bytes are hinted for batches that have not been loaded yet,
+so readahead never pushes out pages that are still to be used.'''
+
+from striate import util
+import collections
+import ctypes
+import ctypes.util
+import os
+import threading
+
+POSIX_FADV_WILLNEED = 3
+
+def _find_fadvise():
+  if hasattr(os, 'posix_fadvise'):
+    return lambda fd, offset, size: os.posix_fadvise(fd, offset, size, os.POSIX_FADV_WILLNEED)
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    fadvise = libc.posix_fadvise
+  except (OSError, AttributeError):
+    return None
+  fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+  return lambda fd, offset, size: fadvise(fd, offset, size, POSIX_FADV_WILLNEED)
+
+_fadvise = _find_fadvise()
+
+def _extent(source):
+  '''Return (path, offset, size) for a path or an extent tuple.'''
+  if isinstance(source, tuple):
+    path, offset, size = source
+    return path, int(offset), int(size)
+  return source, 0, os.path.getsize(source)
+
+
+def willneed(path, offset, size, chunk=1 << 20):
+  '''Start reading size bytes at offset of path into the page cache.'''
+  fd = os.open(path, os.O_RDONLY)
+  try:
+    if _fadvise is not None:
+      _fadvise(fd, offset, size)
+      return
+    os.lseek(fd, offset, os.SEEK_SET)
+    while size > 0:
+      n = len(os.read(fd, min(chunk, size)))
+      if n == 0:
+        break
+      size -= n
+  finally:
+    os.close(fd)
+
+
+class Readahead(object):
+  def __init__(self, budget):
+    self.budget = budget
+    self.hinted_bytes = 0
+    self._queue = collections.deque()
+    # bytes hinted so far for every batch that has not been released
+    self._pending = {}
+    self._outstanding = 0
+    self._cond = threading.Condition()
+    self._closed = False
+    self._thread = threading.Thread(target=self._run)
+    self._thread.setDaemon(True)
+    self._thread.start()
+
+  def hint(self, key, sources):
+    '''Queue the files batch key will read.'''
+    with self._cond:
+      self._pending.setdefault(key, 0)
+      self._queue.extend((key, source) for source in sources)
+      self._cond.notifyAll()
+
+  def release(self, key):
+    '''Called once batch key is loaded; its bytes no longer count against
+    the budget, and whatever of it is still queued is dropped.'''
+    with self._cond:
+      self._outstanding -= self._pending.pop(key, 0)
+      self._cond.notifyAll()
+
+  def close(self):
+    with self._cond:
+      self._closed = True
+      self._cond.notifyAll()
+    self._thread.join()
+
+  def _run(self):
+    while 1:
+      with self._cond:
+        while not self._queue and not self._closed:
+          self._cond.wait()
+        if self._closed:
+          return
+        key, source = self._queue.popleft()
+        if key not in self._pending:
+          continue
+
+      try:
+        path, offset, size = _extent(source)
+      except OSError:
+        continue
+
+      with self._cond:
+        # always let one extent through, or a budget smaller than a file
+        # would stall the readahead for good
+        while (self._outstanding > 0 and self._outstanding + size > self.budget
+               and key in self._pending and not self._closed):
+          self._cond.wait()
+        if self._closed:
+          return
+        if key not in self._pending:
+          continue
+        self._pending[key] += size
+        self._outstanding += size
+        self.hinted_bytes += size
+
+      try:
+        willneed(path, offset, size)
+      except (OSError, IOError):
+        util.log('Readahead of %s failed', path, exc_info=1)
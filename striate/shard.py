@@ -0,0 +1,168 @@
+'''Packed ImageNet shards.
+
+A shard directory holds every image of a synset tree already scaled and
+centre cropped to img_size x img_size, stored as fixed size uint8
+(3, img_size, img_size) records, so a batch is gathered from memory mapped
+files instead of being decoded from JPEGs:
+
+  shards.meta       pickled dict: img_size, records_per_shard, num_records
+  shard-NNNNN.dat   records_per_shard records each (the last may be short)
+  labels.npy        int32 label of each record
+  positions.npy     int32 index of each record within its category directory,
+                    which is what a provider's batch_range selects on
+
+batches.meta and image-mean.pickle are copied over from the source tree.
+Build a shard directory with
+
+  python -m striate.shard --data_dir /ssd/nn-data/imagenet/ --out_dir /ssd/imagenet-shards/
+'''
+
+from striate import util
+from striate.image_index import ImageIndex
+import argparse
+import cPickle
+import functools
+import multiprocessing
+import numpy as np
+import os
+import shutil
+
+META_FILE = 'shards.meta'
+LABEL_FILE = 'labels.npy'
+POSITION_FILE = 'positions.npy'
+
+def shard_filename(shard_dir, shard):
+  return os.path.join(shard_dir, 'shard-%05d.dat' % shard)
+
+
+class ShardWriter(object):
+  def __init__(self, shard_dir, img_size=256, records_per_shard=8192):
+    self.shard_dir = shard_dir
+    self.img_size = img_size
+    self.records_per_shard = records_per_shard
+    self.num_records = 0
+    self.labels = []
+    self.positions = []
+    self._file = None
+
+    if not os.path.exists(shard_dir):
+      os.makedirs(shard_dir)
+
+  def add(self, images, labels, positions):
+    '''Append a (n, 3, img_size, img_size) uint8 array of images.'''
+    assert images.shape[1:] == (3, self.img_size, self.img_size), images.shape
+    images = np.require(images, dtype=np.uint8, requirements='C')
+    for img in images:
+      if self.num_records % self.records_per_shard == 0:
+        self._next_shard()
+      self._file.write(img.data)
+      self.num_records += 1
+
+    self.labels.extend(labels)
+    self.positions.extend(positions)
+
+  def _next_shard(self):
+    if self._file is not None:
+      self._file.close()
+    shard = self.num_records / self.records_per_shard
+    self._file = open(shard_filename(self.shard_dir, shard), 'wb')
+
+  def close(self):
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+
+    np.save(os.path.join(self.shard_dir, LABEL_FILE), np.array(self.labels, dtype=np.int32))
+    np.save(os.path.join(self.shard_dir, POSITION_FILE), np.array(self.positions, dtype=np.int32))
+    meta = {'img_size': self.img_size,
+            'records_per_shard': self.records_per_shard,
+            'num_records': self.num_records}
+    with open(os.path.join(self.shard_dir, META_FILE), 'wb') as f:
+      cPickle.dump(meta, f, protocol=-1)
+
+
+class ShardReader(object):
+  def __init__(self, shard_dir):
+    meta = util.load(os.path.join(shard_dir, META_FILE))
+    self.img_size = meta['img_size']
+    self.records_per_shard = meta['records_per_shard']
+    self.num_records = meta['num_records']
+    self.labels = np.load(os.path.join(shard_dir, LABEL_FILE))
+    self.positions = np.load(os.path.join(shard_dir, POSITION_FILE))
+
+    record_shape = (3, self.img_size, self.img_size)
+    num_shards = util.divup(self.num_records, self.records_per_shard)
+    self.record_bytes = int(np.prod(record_shape))
+    self.shards = []
+    self.filenames = []
+    for shard in range(num_shards):
+      self.filenames.append(shard_filename(shard_dir, shard))
+      mm = np.memmap(self.filenames[-1], dtype=np.uint8, mode='r')
+      self.shards.append(mm.reshape((-1,) + record_shape))
+
+  def extents(self, records):
+    '''Return the (path, offset, size) of every given record.'''
+    return [(self.filenames[r // self.records_per_shard],
+             int(r % self.records_per_shard) * self.record_bytes, self.record_bytes) for r in records]
+
+  def gather(self, records, out=None):
+    '''Copy the given records into out, a (n, 3, img_size, img_size) array.'''
+    records = np.asarray(records)
+    if out is None:
+      out = np.empty((len(records), 3, self.img_size, self.img_size), dtype=np.uint8)
+
+    shard_ids = records / self.records_per_shard
+    for shard in np.unique(shard_ids):
+      mask = shard_ids == shard
+      out[mask] = self.shards[shard][records[mask] - shard * self.records_per_shard]
+    return out
+
+
+def convert(data_dir, out_dir, img_size=256, records_per_shard=8192, num_workers=0, chunk_size=256):
+  # data imports this module for ShardReader, so import it lazily here
+  from striate import data
+
+  batch_meta = util.load(os.path.join(data_dir, 'batches.meta'))
+  index = ImageIndex.open(data_dir, batch_meta)
+  paths = index.paths(range(index.num_images))
+  labels, positions = index.labels, index.positions
+  util.log('Packing %d images into %s', len(paths), out_dir)
+
+  writer = ShardWriter(out_dir, img_size, records_per_shard)
+  decode = functools.partial(data._decode_jpegs, img_size=img_size)
+  starts = range(0, len(paths), chunk_size)
+  chunks = [paths[s:s + chunk_size] for s in starts]
+
+  if num_workers > 0:
+    pool = multiprocessing.Pool(num_workers)
+    decoded = pool.imap(decode, chunks)
+  else:
+    pool = None
+    decoded = (decode(c) for c in chunks)
+
+  for s, images in zip(starts, decoded):
+    writer.add(images, labels[s:s + chunk_size], positions[s:s + chunk_size])
+    if (s / chunk_size) % 100 == 0:
+      util.log('Packed %d/%d images', s + len(images), len(paths))
+
+  if pool is not None:
+    pool.close()
+    pool.join()
+  writer.close()
+
+  for name in ['batches.meta', 'image-mean.pickle']:
+    if os.path.exists(os.path.join(data_dir, name)):
+      shutil.copy(os.path.join(data_dir, name), out_dir)
+  util.log('Wrote %d records', writer.num_records)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--data_dir', help = 'The synset tree to pack', required = True)
+  parser.add_argument('--out_dir', help = 'Where to write the shards', required = True)
+  parser.add_argument('--img_size', help = 'The side of the stored images', default = 256, type = int)
+  parser.add_argument('--records_per_shard', help = 'The number of images per shard file', default = 8192, type = int)
+  parser.add_argument('--num_workers', help = 'The number of decoding processes', default = 0, type = int)
+  args = parser.parse_args()
+
+  convert(args.data_dir, args.out_dir, args.img_size, args.records_per_shard, args.num_workers)
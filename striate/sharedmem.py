@@ -0,0 +1,47 @@
+from multiprocessing.sharedctypes import RawArray
+import Queue
+import numpy as np
+
+class SharedBatchPool(object):
+  '''A fixed number of batch slots allocated once in shared memory.
+
+  Each slot holds one buffer per name in `buffer_bytes`.  A producer takes a
+  free slot with acquire(), fills views of its buffers in place and hands the
+  views on; whoever consumes the batch calls release() once it is done with
+  it.  Worker processes forked after the pool was created see the same
+  memory, so they can fill a slot without the pixels ever being pickled.
+
+  acquire/release are meant to be called from the process that owns the
+  pool; workers only ever touch the buffers.
+
+  Slots can come in groups of different sizes, each with its own free list:
+  add_group() allocates one, and acquire(group) takes a slot of it.  Workers
+  only see the slots that existed when they were forked.'''
+  def __init__(self, num_slots, buffer_bytes):
+    self.num_slots = 0
+    self._buffers = []
+    self._groups = []
+    self._free = {}
+    self.add_group(None, num_slots, buffer_bytes)
+
+  def add_group(self, group, num_slots, buffer_bytes):
+    assert group not in self._free, 'Slot group %s already exists' % group
+    self._free[group] = Queue.Queue()
+    for i in range(num_slots):
+      self._buffers.append(dict((name, RawArray('c', int(nbytes)))
+                                for name, nbytes in buffer_bytes.items()))
+      self._groups.append(group)
+      self._free[group].put(self.num_slots)
+      self.num_slots += 1
+
+  def acquire(self, group=None):
+    '''Block until a slot of group is free and return its id.'''
+    return self._free[group].get()
+
+  def release(self, slot):
+    self._free[self._groups[slot]].put(slot)
+
+  def view(self, slot, name, shape, dtype):
+    '''Return a C-contiguous array over the start of a slot buffer.'''
+    count = int(np.prod(shape))
+    return np.frombuffer(self._buffers[slot][name], dtype=dtype, count=count).reshape(shape)
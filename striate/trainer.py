@@ -1,11 +1,13 @@
-from data import DataProvider, ImageNetDataProvider
+from data import DataProvider, ImageNetDataProvider, SampleStore
 from pycuda import gpuarray, driver
 from striate import util, layer
+from striate import checkpoint
+from striate.checkpoint import CheckpointWriter
 from striate.fastnet import FastNet, AdaptiveFastNet
 from striate.layer import TRAIN, TEST
 from striate.parser import Parser
 from striate.scheduler import Scheduler
-from striate.util import divup, timer, load
+from striate.util import divup, timer
 import argparse
 import cPickle
 import glob
@@ -54,10 +56,14 @@ class DataDumper(object):
 class Trainer:
   CHECKPOINT_REGEX = None
   def __init__(self, test_id, data_dir, data_provider, checkpoint_dir, train_range, test_range, test_freq, save_freq, batch_size, num_epoch, image_size,
-               image_color, learning_rate, auto_init=False, init_model=None, adjust_freq=1, factor=1.0):
+               image_color, learning_rate, auto_init=False, init_model=None, adjust_freq=1, factor=1.0,
+               dp_params=None, checkpoint_format='pickle', checkpoint_half='none',
+               checkpoint_codec='zlib', checkpoint_threads=4):
     self.test_id = test_id
     self.data_dir = data_dir
     self.data_provider = data_provider
+    # extra keyword arguments handed to every data provider we construct
+    self.dp_params = dp_params or {}
     self.checkpoint_dir = checkpoint_dir
     self.train_range = train_range
     self.test_range = test_range
@@ -74,6 +80,8 @@ class Trainer:
     self.adjust_freq = adjust_freq
     self.regex = re.compile('^test%d-(\d+)\.(\d+)$' % self.test_id)
 
+    self.train_dp = self.test_dp = None
+    self.sample_store = None
     self.init_data_provider()
     self.image_shape = (self.batch_size, self.image_color, self.image_size, self.image_size)
 
@@ -93,37 +101,72 @@ class Trainer:
     self.num_train_minibatch = 0
     self.num_test_minibatch = 0
     self.checkpoint_file = ''
+    # checkpoint_codec and checkpoint_threads only apply to compressed checkpoints
+    cp_options = {}
+    if checkpoint_format == 'compressed':
+      cp_options = {'codec': checkpoint_codec, 'num_threads': checkpoint_threads}
+    self.checkpoint_writer = CheckpointWriter(checkpoint_format, checkpoint_half, **cp_options)
     
     self.train_dumper = None #DataDumper('/scratch1/imagenet-pickle/train-data.pickle')
     self.test_dumper = None #DataDumper('/scratch1/imagenet-pickle/test-data.pickle')
     self.input = None
+    self.locked_data = None
 
 
   def init_data_provider(self):
+    self.close_data_provider()
     dp = DataProvider.get_by_name(self.data_provider)
-    self.train_dp = dp(self.data_dir, self.train_range)
-    self.test_dp = dp(self.data_dir, self.test_range)
+    self.train_dp = self.stage_data_provider(dp, self.train_range)
+    self.test_dp = self.stage_data_provider(dp, self.test_range, test=True)
+
+  def stage_data_provider(self, dp, batch_range, *args, **kw):
+    '''Build a provider with self.dp_params.  ImageNet providers are built
+    over one SampleStore kept for the whole run, so the training and test
+    providers share a single image cache and decode pool, and a trainer
+    that replaces them between stages starts with the index, the workers
+    and the warm cache of the last stage.'''
+    params = dict(self.dp_params)
+    params.update(kw)
+    if issubclass(dp, ImageNetDataProvider):
+      if self.sample_store is None:
+        self.sample_store = SampleStore(self.data_dir, **dict((k, self.dp_params[k])
+            for k in SampleStore.PARAMS if k in self.dp_params))
+      params['store'] = self.sample_store
+    return dp(self.data_dir, batch_range, *args, **params)
+
+  def close_data_provider(self):
+    for dp in [self.train_dp, self.test_dp]:
+      if dp is not None:
+        dp.close()
+    self.train_dp = self.test_dp = None
+
+  def close(self):
+    '''Stop the providers and the decode workers of the sample store.  The
+    staged trainers run train() once per stage, so this is left to whoever
+    started the training.'''
+    self.close_data_provider()
+    if self.sample_store is not None:
+      self.sample_store.close()
+      self.sample_store = None
 
 
   def get_next_minibatch(self, i, train=TRAIN):
     if train == TRAIN:
       data = self.train_data
+      dp = self.train_dp
     else:
       data = self.test_data
+      dp = self.test_dp
 
     batch_data = data.data
     batch_label = data.labels
     batch_size = self.batch_size
 
-    mini_data = batch_data[:, i * batch_size: (i + 1) * batch_size]
-    locked_data = driver.pagelocked_empty(mini_data.shape, mini_data.dtype, order='C',
-                                          mem_flags=driver.host_alloc_flags.PORTABLE)
-    locked_data[:] = mini_data
-
-    if self.input is not None and locked_data.shape == self.input.shape:
-      self.input.set(locked_data)
+    if dp.sample_major:
+      mini_data = batch_data[i * batch_size: (i + 1) * batch_size]
     else:
-      self.input = gpuarray.to_gpu(locked_data)
+      mini_data = batch_data[:, i * batch_size: (i + 1) * batch_size]
+    self.upload_input(mini_data, data.mean, dp.sample_major)
     
     label = batch_label[i * batch_size : (i + 1) * batch_size]
     #label = gpuarray.to_gpu(label)
@@ -134,14 +177,56 @@ class Trainer:
     return self.input, label
 
 
+  def upload_input(self, mini_data, mean=None, sample_major=False):
+    '''Copy a minibatch to the GPU through a reused page-locked buffer.  If
+    the batch holds raw pixels, the conversion to float and the mean
+    subtraction happen in the same pass as that copy.  A sample major
+    minibatch is transposed into the network's (dims, cases) layout by that
+    pass as well.'''
+    shape = mini_data.shape[::-1] if sample_major else mini_data.shape
+    if self.locked_data is None or self.locked_data.shape != shape:
+      self.locked_data = driver.pagelocked_empty(shape, np.float32, order='C',
+                                                 mem_flags=driver.host_alloc_flags.PORTABLE)
+    locked_data = self.locked_data
+    if sample_major:
+      util.blocked_transpose(mini_data, locked_data, mean)
+    elif mean is None:
+      locked_data[:] = mini_data
+    else:
+      np.subtract(mini_data, mean, out=locked_data)
+
+    if self.input is not None and locked_data.shape == self.input.shape:
+      self.input.set(locked_data)
+    else:
+      self.input = gpuarray.to_gpu(locked_data)
+    return self.input
+
+  def get_multiview_minibatch(self, i):
+    '''Return a generator uploading each view of test minibatch i in turn,
+    and the labels of its images.'''
+    dp = self.test_dp
+    num_imgs = dp.get_num_cases(self.test_data) / dp.num_views
+    start = i * self.batch_size
+    end = min((i + 1) * self.batch_size, num_imgs)
+
+    data = self.test_data.data
+    def view(v):
+      cases = slice(v * num_imgs + start, v * num_imgs + end)
+      return data[cases] if dp.sample_major else data[:, cases]
+
+    views = (self.upload_input(view(v), self.test_data.mean, dp.sample_major)
+             for v in range(dp.num_views))
+    return views, self.test_data.labels[start:end]
+
   def save_checkpoint(self):
     model = {}
     model['batchnum'] = self.train_dp.get_batch_num()
     model['epoch'] = self.num_epoch + 1
-    model['layers'] = self.net.get_dumped_layers()
+    model['layers'] = self.checkpoint_writer.snapshot(self.net)
 
-    model['train_outputs'] = self.train_outputs
-    model['test_outputs'] = self.test_outputs
+    # copies, as training keeps appending while the checkpoint is written
+    model['train_outputs'] = list(self.train_outputs)
+    model['test_outputs'] = list(self.test_outputs)
 
     dic = {'model_state': model, 'op':None}
     self.print_net_summary()
@@ -149,27 +234,43 @@ class Trainer:
     if not os.path.exists(self.checkpoint_dir):
       os.system('mkdir -p \'%s\'' % self.checkpoint_dir)
     
-    saved_filename = [f for f in os.listdir(self.checkpoint_dir) if self.regex.match(f)]
-    for f in saved_filename:
-      os.remove(os.path.join(self.checkpoint_dir, f))
+    saved_filename = [os.path.join(self.checkpoint_dir, f)
+                      for f in os.listdir(self.checkpoint_dir) if self.regex.match(f)]
     checkpoint_filename = "test%d-%d.%d" % (self.test_id, self.curr_epoch, self.curr_batch)
     checkpoint_file_path = os.path.join(self.checkpoint_dir, checkpoint_filename)
     self.checkpoint_file = checkpoint_file_path
     print >> sys.stderr,  checkpoint_file_path
-    with open(checkpoint_file_path, 'w') as f:
-      cPickle.dump(dic, f, protocol=-1)
-    util.log('save file finished')
+    self.checkpoint_writer.write(dic, checkpoint_file_path, replaces=saved_filename)
+
+  def load_checkpoint(self):
+    '''Load the last checkpoint saved, once it is on disk.'''
+    self.checkpoint_writer.wait()
+    return checkpoint.load(self.checkpoint_file)
+
+  def _test_minibatches(self, capture=False):
+    '''Run the net over every minibatch of self.test_data, handing each one
+    to the test dumper if capture is set.'''
+    dp = self.test_dp
+    num_imgs = dp.get_num_cases(self.test_data)
+    if dp.multiview:
+      num_imgs /= dp.num_views
+    self.num_test_minibatch = divup(num_imgs, self.batch_size)
+    for i in range(self.num_test_minibatch):
+      if dp.multiview:
+        views, label = self.get_multiview_minibatch(i)
+        # the dumper captures the fc features, averaged over the views
+        self.net.test_multiview(views, label, [-3] if capture and self.test_dumper else ())
+      else:
+        input, label = self.get_next_minibatch(i, TEST)
+        self.net.train_batch(input, label, TEST)
+      if capture:
+        self._capture_test_data()
 
   def get_test_error(self):
     start = time.time()
     self.test_data = self.test_dp.get_next_batch()
+    self._test_minibatches(capture=True)
 
-    self.num_test_minibatch = divup(self.test_data.data.shape[1], self.batch_size)
-    for i in range(self.num_test_minibatch):
-      input, label = self.get_next_minibatch(i, TEST)
-      self.net.train_batch(input, label, TEST)
-      self._capture_test_data()
-    
     cost , correct, numCase, = self.net.get_batch_information()
     self.test_outputs += [({'logprob': [cost, 1 - correct]}, numCase, time.time() - start)]
     print >> sys.stderr,  '[%d] error: %f logreg: %f time: %f' % (self.test_data.batchnum, 1 - correct, cost, time.time() - start)
@@ -224,7 +325,7 @@ class Trainer:
       self.curr_batch = self.train_data.batchnum
 
       start = time.time()
-      self.num_train_minibatch = divup(self.train_data.data.shape[1], self.batch_size)
+      self.num_train_minibatch = divup(self.train_dp.get_num_cases(self.train_data), self.batch_size)
       t = 0
       
       for i in range(self.num_train_minibatch):
@@ -263,6 +364,7 @@ class Trainer:
 
     self.get_test_error()
     self.save_checkpoint()
+    self.checkpoint_writer.wait()
     self.report()
     self._finished_training()
 
@@ -276,11 +378,7 @@ class Trainer:
       self.test_data = self.test_dp.get_next_batch()
       self.curr_epoch = self.test_data.epoch
       self.curr_batch = self.test_data.batchnum
-
-      self.num_test_minibatch = divup(self.test_data.data.shape[1], self.batch_size)
-      for i in range(self.num_test_minibatch):
-        input, label = self.get_next_minibatch(i, TEST)
-        self.net.train_batch(input, label, TEST)
+      self._test_minibatches()
       cost , correct, numCase = self.net.get_batch_information()
       print >> sys.stderr,  '%d.%d: error: %f logreg: %f time: %f' % (self.curr_epoch, self.curr_batch, 1 - correct, cost, time.time() - start)
       if save_layers is not None:
@@ -304,13 +402,14 @@ class Trainer:
 class MiniBatchTrainer(Trainer):
   def __init__(self, test_id, data_dir, data_provider, checkpoint_dir, train_range, test_range,
       test_freq, save_freq, batch_size, num_minibatch, image_size, image_color, learning_rate,
-      init_model=None, adjust_freq=1, factor=1.0):
+      init_model=None, adjust_freq=1, factor=1.0, dp_params=None, **checkpoint_params):
 
     self.num_minibatch = num_minibatch
     fake_num_epoch = 100
     Trainer.__init__(self, test_id, data_dir, data_provider, checkpoint_dir, train_range,
         test_range, test_freq, save_freq, batch_size, fake_num_epoch, image_size, image_color,
-        learning_rate,  init_model = init_model, adjust_freq = adjust_freq, factor = factor)
+        learning_rate,  init_model = init_model, adjust_freq = adjust_freq, factor = factor,
+        dp_params = dp_params, **checkpoint_params)
 
   def should_continue_training(self):
     return self.curr_minibatch <= self.num_minibatch
@@ -405,7 +504,7 @@ class LayerwisedTrainer(AutoStopTrainer):
       for i in range(len(self.n_filters) - 1):
         next_n_filter = [self.n_filters[i + 1]]
         next_size_filter = [self.size_filters[i + 1]]
-        model = load(self.checkpoint_file)
+        model = self.load_checkpoint()
         self.net = FastNet(self.learning_rate, self.image_shape, 0, initModel=model)
         self.net.del_layer()
         self.net.del_layer()
@@ -479,14 +578,15 @@ class ImageNetLayerwisedTrainer(AutoStopTrainer):
     pass
 
   def init_data_provider(self):
-    self.train_dp = ImageNetDataProvider(self.data_dir, self.train_range)
-    self.test_dp = ImageNetDataProvider(self.data_dir, self.test_range)
+    self.close_data_provider()
+    self.train_dp = self.stage_data_provider(ImageNetDataProvider, self.train_range)
+    self.test_dp = self.stage_data_provider(ImageNetDataProvider, self.test_range, test=True)
 
   def train(self):
     # train conv stack layer by layer
     for i, stack in enumerate(self.conv_stack):
       if self.checkpoint_file != '':
-        model = load(self.checkpoint_file)
+        model = self.load_checkpoint()
         self.net = FastNet(self.learning_rate, self.image_shape, self.n_out, initModel=model)
         # delete softmax layer
         self.net.del_layer()
@@ -509,7 +609,7 @@ class ImageNetLayerwisedTrainer(AutoStopTrainer):
 
     # train fc layer
     for i, stack in enumerate(self.fc_stack):
-      model = load(self.checkpoint_file)
+      model = self.load_checkpoint()
       self.net = FastNet(self.learning_rate, self.image_shape, self.n_out, initModel=model)
       self.net.del_layer()
       self.net.del_layer()
@@ -529,7 +629,7 @@ class ImageNetLayerwisedTrainer(AutoStopTrainer):
       self.train_output = []
       AutoStopTrainer.train(self)
 
-    model = load(self.checkpoint_file)
+    model = self.load_checkpoint()
     self.test_id += 1
     self.net = FastNet(self.learning_rate, self.image_shape, self.n_out, initModel=model)
     self.test_range = self.origin_test_range
@@ -543,7 +643,8 @@ class ImageNetLayerwisedTrainer(AutoStopTrainer):
 class ImageNetCatewisedTrainer(MiniBatchTrainer):
   def __init__(self, test_id, data_dir, data_provider, checkpoint_dir, train_range, test_range,
       test_freq, save_freq, batch_size, num_minibatch, image_size, image_color, learning_rate,
-      init_model, num_caterange_list, adjust_freq = 100, factor = 1.0):
+      init_model, num_caterange_list, adjust_freq = 100, factor = 1.0, dp_params = None,
+      **checkpoint_params):
     # no meaning
     assert len(num_caterange_list) == len(num_minibatch) and num_caterange_list[-1] == 1000
 
@@ -559,7 +660,7 @@ class ImageNetCatewisedTrainer(MiniBatchTrainer):
 
     MiniBatchTrainer.__init__(self, test_id, data_dir, data_provider, checkpoint_dir, train_range,
         test_range, test_freq, save_freq, batch_size, num_minibatch[0], image_size, image_color,
-        self.learning_rate,  init_model = init_model)
+        self.learning_rate,  init_model = init_model, dp_params = dp_params, **checkpoint_params)
 
   def init_data_provider(self):
     ''' we begin with 100 categories'''
@@ -567,8 +668,9 @@ class ImageNetCatewisedTrainer(MiniBatchTrainer):
 
   def set_category_range(self, r):
     dp = DataProvider.get_by_name(self.data_provider)
-    self.train_dp = dp(self.data_dir, self.train_range, category_range = range(r))
-    self.test_dp = dp(self.data_dir, self.test_range, category_range = range(r))
+    self.close_data_provider()
+    self.train_dp = self.stage_data_provider(dp, self.train_range, category_range = range(r))
+    self.test_dp = self.stage_data_provider(dp, self.test_range, category_range = range(r), test = True)
 
 
   def train(self):
@@ -580,7 +682,7 @@ class ImageNetCatewisedTrainer(MiniBatchTrainer):
       self.curr_minibatch = 0
       self.num_minibatch = self.train_minibatch_list[i]
 
-      model = load(self.checkpoint_file)
+      model = self.load_checkpoint()
       layers = model['model_state']['layers']
 
       for l in layers:
@@ -605,7 +707,8 @@ class ImageNetCatewisedTrainer(MiniBatchTrainer):
 class ImageNetCateGroupTrainer(MiniBatchTrainer):
   def __init__(self, test_id, data_dir, data_provider, checkpoint_dir, train_range, test_range,
       test_freq, save_freq, batch_size, num_minibatch, image_size, image_color, learning_rate,
-      num_group_list, init_model, adjust_freq = 100, factor = 1.0):
+      num_group_list, init_model, adjust_freq = 100, factor = 1.0, dp_params = None,
+      **checkpoint_params):
 
     self.train_minibatch_list = num_minibatch[1:]
     self.num_group_list = num_group_list[1:]
@@ -616,13 +719,15 @@ class ImageNetCateGroupTrainer(MiniBatchTrainer):
     fc['outputSize'] = num_group_list[0]
 
     MiniBatchTrainer.__init__(self, test_id, data_dir, data_provider, checkpoint_dir, train_range, test_range,
-        test_freq, save_freq, batch_size, num_minibatch[0], image_size, image_color, learning_rate[0], init_model = init_model)
+        test_freq, save_freq, batch_size, num_minibatch[0], image_size, image_color, learning_rate[0], init_model = init_model,
+        dp_params = dp_params, **checkpoint_params)
 
 
   def set_num_group(self, n):
     dp = DataProvider.get_by_name(self.data_provider)
-    self.train_dp = dp(self.data_dir, self.train_range, n)
-    self.test_dp = dp(self.data_dir, self.test_range, n)
+    self.close_data_provider()
+    self.train_dp = self.stage_data_provider(dp, self.train_range, n)
+    self.test_dp = self.stage_data_provider(dp, self.test_range, n, test=True)
 
   def init_data_provider(self):
     self.set_num_group(self.n_out)
@@ -636,7 +741,7 @@ class ImageNetCateGroupTrainer(MiniBatchTrainer):
       self.curr_minibatch = 0
       self.num_minibatch = self.train_minibatch_list[i]
 
-      model = load(self.checkpoint_file)
+      model = self.load_checkpoint()
       layers = model['model_state']['layers']
 
       fc = layers[-2]
@@ -684,7 +789,7 @@ if __name__ == '__main__':
   parser.add_argument('--test_id', help = 'Test Id', default = None, type = int)
   parser.add_argument('--data_dir', help = 'The directory that data stored')
   parser.add_argument('--param_file', help = 'The param_file or checkpoint file')
-  parser.add_argument('--data_provider', help = 'The data provider', choices =['cifar10','imagenet', 'imagenetcategroup'])
+  parser.add_argument('--data_provider', help = 'The data provider', choices =['cifar10', 'cifar10mem', 'imagenet', 'imagenetcategroup', 'imagenetshard', 'imagenettar', 'synthetic'])
   parser.add_argument('--train_range', help = 'The range of the train set')
   parser.add_argument('--test_range', help = 'THe range of the test set')
   parser.add_argument('--save_freq', help = 'How often should I save the checkpoint file', default = 100, type = int)
@@ -694,13 +799,42 @@ if __name__ == '__main__':
   parser.add_argument('--learning_rate' , help = 'The scale learning rate', default = '0.1')
   parser.add_argument('--batch_size', help = 'The size of batch', default = 128, type = int)
   parser.add_argument('--checkpoint_dir', help = 'The directory to save checkpoint file')
+  parser.add_argument('--checkpoint_format', help = 'Save checkpoints as one pickle, a directory of .npy arrays, '
+                      'manifests of shared blobs, or one chunk compressed file',
+                      default = 'pickle', choices = sorted(checkpoint.FORMATS))
+  parser.add_argument('--checkpoint_codec', help = 'Codec of compressed checkpoints',
+                      default = 'zlib', choices = sorted(checkpoint.CODECS))
+  parser.add_argument('--checkpoint_threads', help = 'Threads compressing a checkpoint', default = 4, type = int)
+  parser.add_argument('--checkpoint_half', help = 'Store the momentum buffers, or all layer arrays, of checkpoints as float16',
+                      default = 'none', choices = sorted(checkpoint.HALF_ARRAYS))
+  parser.add_argument('--num_workers', help = 'The number of processes decoding images for the data provider', default = 0, type = int)
+  parser.add_argument('--prefetch', help = 'How many batches may be loaded ahead of the trainer on top of one per reader', default = 1, type = int)
+  parser.add_argument('--num_readers', help = 'The number of threads loading batches in the background', default = 1, type = int)
+  parser.add_argument('--raw_pixels', help = 'Queue uint8 batches and subtract the mean just before training', default = 0, type = int)
+  parser.add_argument('--cache_mem', help = 'MB of RAM to keep decoded images in across epochs', default = 0, type = int)
+  parser.add_argument('--cache_disk', help = 'MB of local disk to spill decoded images to', default = 0, type = int)
+  parser.add_argument('--cache_dir', help = 'Directory for the on-disk image cache', default = '/tmp')
+  parser.add_argument('--readahead', help = 'MB of upcoming batch files to ask the OS to read ahead', default = 0, type = int)
+  parser.add_argument('--augment', help = 'Augmentation stages for training batches, e.g. crop:224,flip,lighting:0.1', default = '')
+  parser.add_argument('--sample_major', help = 'Assemble batches with one image per row and transpose each minibatch on upload', default = 0, type = int)
+  parser.add_argument('--synthetic_size', help = 'Image size of the synthetic data provider', default = 224, type = int)
+  parser.add_argument('--synthetic_classes', help = 'Number of classes of the synthetic data provider', default = 1000, type = int)
+  parser.add_argument('--synthetic_images', help = 'Images per batch of the synthetic data provider', default = 1024, type = int)
+  parser.add_argument('--synthetic_batches', help = 'Batches per epoch of the synthetic data provider, instead of the train and test ranges', type = int)
+  parser.add_argument('--rank', help = 'Which shard of the data this process trains on', default = 0, type = int)
+  parser.add_argument('--world_size', help = 'How many processes share the data', default = 1, type = int)
+  parser.add_argument('--data_seed', help = 'Seed for shuffling and sharding the data, the same for every rank', type = int)
+  parser.add_argument('--multiview_test', help = 'Average the predictions over 10 crops of every test image', default = 0, type = int)
 
   parser.add_argument('--trainer', help = 'The type of the trainer', default = 'normal', choices =
       ['normal', 'catewise', 'categroup', 'minibatch'])
 
 
   # extra argument
-  extra_argument = ['num_group_list', 'num_caterange_list', 'num_epoch', 'num_minibatch']
+  extra_argument = ['num_group_list', 'num_caterange_list', 'num_epoch', 'num_minibatch', 'num_workers',
+                    'prefetch', 'num_readers', 'multiview_test', 'raw_pixels', 'sample_major',
+                    'cache_mem', 'cache_disk', 'readahead', 'augment',
+                    'rank', 'world_size', 'data_seed', 'synthetic_batches']
   parser.add_argument('--num_group_list', help = 'The list of the group you want to split the data to')
   parser.add_argument('--num_caterange_list', help = 'The list of category range you want to train')
   parser.add_argument('--num_epoch', help = 'The number of epoch you want to train', default = 30, type = int)
@@ -722,6 +856,8 @@ if __name__ == '__main__':
     param_dict['image_size'] = 224
   elif args.data_provider.startswith('cifar'):
     param_dict['image_size'] = 32
+  elif args.data_provider == 'synthetic':
+    param_dict['image_size'] = args.synthetic_size
   else:
     assert False, 'Unknown data_provider %s' % args.data_provider
  
@@ -746,6 +882,47 @@ if __name__ == '__main__':
 
   param_dict['batch_size'] = args.batch_size
   param_dict['checkpoint_dir'] = args.checkpoint_dir
+  param_dict['checkpoint_format'] = args.checkpoint_format
+  param_dict['checkpoint_half'] = args.checkpoint_half
+  param_dict['checkpoint_codec'] = args.checkpoint_codec
+  param_dict['checkpoint_threads'] = args.checkpoint_threads
+
+  dp_params = {}
+  if args.num_workers:
+    dp_params['num_workers'] = args.num_workers
+  if args.prefetch != 1:
+    dp_params['prefetch'] = args.prefetch
+  if args.num_readers != 1:
+    dp_params['num_readers'] = args.num_readers
+  if args.multiview_test:
+    assert issubclass(DataProvider.get_by_name(args.data_provider), ImageNetDataProvider), \
+        '--multiview_test needs an ImageNet data provider, not %s' % args.data_provider
+    # only the test provider takes the views; the training one ignores it
+    dp_params['multiview'] = True
+  if args.raw_pixels:
+    dp_params['raw_pixels'] = True
+  if args.sample_major:
+    dp_params['sample_major'] = True
+  if args.augment:
+    dp_params['augment'] = args.augment
+  if args.world_size != 1:
+    dp_params['rank'] = args.rank
+    dp_params['world_size'] = args.world_size
+  if args.data_seed is not None:
+    dp_params['seed'] = args.data_seed
+  if args.data_provider == 'synthetic':
+    dp_params['image_size'] = args.synthetic_size
+    dp_params['num_classes'] = args.synthetic_classes
+    dp_params['images_per_batch'] = args.synthetic_images
+    if args.synthetic_batches:
+      dp_params['num_batches'] = args.synthetic_batches
+  if args.cache_mem or args.cache_disk:
+    dp_params['cache_mem'] = args.cache_mem * 2 ** 20
+    dp_params['cache_disk'] = args.cache_disk * 2 ** 20
+    dp_params['cache_dir'] = args.cache_dir
+  if args.readahead:
+    dp_params['readahead'] = args.readahead * 2 ** 20
+  param_dict['dp_params'] = dp_params
   trainer = args.trainer
 
   cp_pattern = param_dict['checkpoint_dir'] + '/test%d' % param_dict['test_id']
@@ -757,9 +934,12 @@ if __name__ == '__main__':
   else:
     cp_file = sorted(cp_files, key=os.path.getmtime)[-1]
     util.log('Loading from checkpoint file: %s', cp_file)
-    param_dict['init_model'] = util.load(cp_file)
+    param_dict['init_model'] = checkpoint.load(cp_file)
 
   trainer = get_trainer_by_name(trainer, param_dict, args)
   util.log('start to train...')
-  trainer.train()
+  try:
+    trainer.train()
+  finally:
+    trainer.close()
   #trainer.predict(['pool5'], 'image.opt')
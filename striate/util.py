@@ -52,11 +52,31 @@ def divup(x, base):
   else:
     return x / base + 1
 
+def blocked_transpose(src, dst, mean=None, block=512):
+  '''Write src.T into dst, subtracting the (rows, 1) column mean from it if
+  one is given.
+
+  The copy goes block columns of src at a time: each step reads a narrow
+  strip of every row of src and writes a few whole rows of dst, and both fit
+  in cache, instead of striding across all of src for every row of dst.'''
+  assert dst.shape == src.shape[::-1]
+  for start in range(0, src.shape[1], block):
+    end = start + block
+    if mean is None:
+      dst[start:end] = src[:, start:end].T
+    else:
+      np.subtract(src[:, start:end].T, mean[start:end], out=dst[start:end])
+  return dst
+
 def load(filename):
   with open(filename, 'rb') as f:
     model = cPickle.load(f)
   return model
 
+def save(obj, filename):
+  with open(filename, 'wb') as f:
+    cPickle.dump(obj, f, protocol=-1)
+
 def isfloat(value):
   try:
     float(value)
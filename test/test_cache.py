@@ -0,0 +1,51 @@
+from striate import cache
+import numpy as np
+import shutil
+import tempfile
+
+def image(key):
+  return np.zeros((2, 2), dtype=np.uint8) + key
+
+def test_tier_lru():
+  evicted = []
+  tier = cache._Tier(np.zeros((2, 2, 2), dtype=np.uint8))
+  tier.put(1, image(1), lambda k, r: evicted.append(k))
+  tier.put(2, image(2), lambda k, r: evicted.append(k))
+  # touching 1 makes 2 the least recently used
+  assert (tier.get(1) == 1).all()
+  tier.put(3, image(3), lambda k, r: evicted.append((k, r[0, 0])))
+  assert evicted == [(2, 2)]
+  assert 1 in tier and 3 in tier and 2 not in tier
+  assert (tier.get(3) == 3).all()
+
+def test_spill_to_disk():
+  disk_dir = tempfile.mkdtemp()
+  try:
+    c = cache.ImageCache((2, 2), mem_bytes=2 * 4, disk_dir=disk_dir, disk_bytes=2 * 4)
+    for key in range(5):
+      c.put(key, image(key))
+    # 3 and 4 in RAM, 1 and 2 spilled to disk, 0 dropped
+    assert len(c.mem) == 2 and len(c.disk) == 2
+    assert c.evictions == 1
+
+    out = np.zeros((3, 2, 2), dtype=np.uint8)
+    assert len(c.fetch([4, 3, 2], out)) == 0
+    assert [out[i, 0, 0] for i in range(3)] == [4, 3, 2]
+    assert c.hits == 2 and c.disk_hits == 1
+    # 2 moved up into RAM and pushed 4 down to disk, which dropped 1
+    assert 2 in c.mem and 4 in c.disk and c.evictions == 2
+    assert list(c.fetch([1, 0], out)) == [0, 1]
+    assert list(c.contains([0, 2, 4])) == [False, True, True]
+  finally:
+    shutil.rmtree(disk_dir)
+
+def test_no_ram():
+  c = cache.ImageCache((2, 2), mem_bytes=0)
+  c.put(0, image(0))
+  assert len(c.mem) == 0 and c.evictions == 1
+  assert list(c.fetch([0], np.zeros((1, 2, 2), dtype=np.uint8))) == [0]
+
+if __name__ == '__main__':
+  test_tier_lru()
+  test_spill_to_disk()
+  test_no_ram()
@@ -0,0 +1,152 @@
+from striate import checkpoint
+import numpy as np
+import os
+import shutil
+import tempfile
+import time
+
+def make_checkpoint():
+  rng = np.random.RandomState(0)
+  layers = [{'name': 'conv1', 'type': 'conv', 'epsW': 0.001,
+             'weight': rng.randn(75, 64).astype(np.float32),
+             'bias': rng.randn(64, 1).astype(np.float32),
+             'weightIncr': rng.randn(75, 64).astype(np.float32),
+             'biasIncr': rng.randn(64, 1).astype(np.float32)},
+            {'name': 'pool1', 'type': 'pool'}]
+  return {'model_state': {'layers': layers, 'batchnum': 3, 'epoch': 2,
+                          'train_outputs': [1, 2], 'test_outputs': []},
+          'op': None}
+
+def check_loaded(loaded, obj, half):
+  assert loaded['op'] is None
+  assert loaded['model_state']['train_outputs'] == [1, 2]
+  assert loaded['model_state']['epoch'] == 2
+  for got, want in zip(loaded['model_state']['layers'], obj['model_state']['layers']):
+    assert sorted(got) == sorted(want)
+    for name, value in want.items():
+      if not isinstance(value, np.ndarray):
+        assert got[name] == value
+        continue
+      assert got[name].dtype == np.float32 and got[name].shape == value.shape
+      if name in checkpoint.HALF_ARRAYS[half]:
+        assert np.allclose(got[name], value, rtol=1e-3, atol=1e-3)
+      else:
+        assert (got[name] == value).all()
+
+def test_round_trip():
+  obj = make_checkpoint()
+  options = {'compressed': {'chunk_bytes': 1000}, 'blobs': {}}
+  for format in sorted(checkpoint.FORMATS):
+    for half in sorted(checkpoint.HALF_ARRAYS):
+      for codec in (sorted(checkpoint.CODECS) if format == 'compressed' else [None]):
+        d = tempfile.mkdtemp()
+        try:
+          kw = dict(options.get(format, {}))
+          if codec is not None:
+            kw['codec'] = codec
+          writer = checkpoint.CheckpointWriter(format, half, **kw)
+          filename = os.path.join(d, 'test1-1.1')
+          writer.write(obj, filename)
+          writer.wait()
+          check_loaded(checkpoint.load(filename), obj, half)
+        finally:
+          shutil.rmtree(d)
+
+class FakeLayer(object):
+  def __init__(self, name, weight):
+    self.name = name
+    self.weight = weight
+
+  def dump(self, host=None):
+    '''Like WeightedLayer.dump: copy weight into host, allocated once.'''
+    if host is None:
+      return {'name': self.name, 'weight': self.weight.copy()}
+    if 'weight' not in host:
+      host['weight'] = np.empty_like(self.weight)
+    host['weight'][:] = self.weight
+    return {'name': self.name, 'weight': host['weight']}
+
+
+class FakeNet(object):
+  def __init__(self):
+    self.layers = [FakeLayer('fc1', np.ones((4, 3), dtype=np.float32)),
+                   FakeLayer('fc2', np.zeros((3, 2), dtype=np.float32))]
+
+  def get_dumped_layers(self, hosts=None):
+    return [l.dump(hosts[i] if hosts is not None else None) for i, l in enumerate(self.layers)]
+
+
+def test_writer():
+  d = tempfile.mkdtemp()
+  try:
+    net = FakeNet()
+    writer = checkpoint.CheckpointWriter()
+    layers = writer.snapshot(net)
+    old = os.path.join(d, 'test1-1.1')
+    writer.write({'model_state': {'layers': layers}}, old)
+
+    # the next snapshot waits for the write, then reuses its host buffers
+    net.layers[0].weight += 1
+    again = writer.snapshot(net)
+    assert again[0]['weight'] is layers[0]['weight']
+    assert (checkpoint.load(old)['model_state']['layers'][0]['weight'] == 1).all()
+
+    new = os.path.join(d, 'test1-1.2')
+    writer.write({'model_state': {'layers': again}}, new, replaces=[old, new])
+    writer.wait()
+    # renamed into place, the replaced checkpoint removed, no temporaries left
+    assert os.listdir(d) == ['test1-1.2']
+    assert (checkpoint.load(new)['model_state']['layers'][0]['weight'] == 2).all()
+
+    # errors of the background write come out of wait(), once
+    writer.write({'model_state': {'layers': again}}, os.path.join(d, 'missing', 'test1-1.3'))
+    try:
+      writer.wait()
+      assert False, 'wait() should raise the write error'
+    except (IOError, OSError):
+      pass
+    writer.wait()
+    assert os.listdir(d) == ['test1-1.2']
+  finally:
+    shutil.rmtree(d)
+
+def test_collect_blobs():
+  d = tempfile.mkdtemp()
+  try:
+    writer = checkpoint.CheckpointWriter('blobs')
+    old_obj = make_checkpoint()
+    old = os.path.join(d, 'test1-1.1')
+    writer.write(old_obj, old)
+    writer.wait()
+
+    # only the increments change, the weights and biases are shared
+    new_obj = make_checkpoint()
+    conv = new_obj['model_state']['layers'][0]
+    conv['weightIncr'] = conv['weightIncr'] + 1
+    conv['biasIncr'] = conv['biasIncr'] + 1
+    blob_dir = os.path.join(d, checkpoint.BLOB_DIR)
+    # a temporary left by a writer that died long ago
+    dead_tmp = os.path.join(blob_dir, 'dead.npy.tmp')
+    open(dead_tmp, 'w').close()
+    long_ago = time.time() - 2 * checkpoint.STALE_TMP_SECONDS
+    os.utime(dead_tmp, (long_ago, long_ago))
+
+    new = os.path.join(d, 'test1-1.2')
+    writer.write(new_obj, new, replaces=[old])
+    writer.wait()
+
+    def blob(layer, name):
+      return checkpoint.blob_key(layer[name]) + '.npy'
+    old_conv = old_obj['model_state']['layers'][0]
+    blobs = set(os.listdir(blob_dir)) - set([checkpoint.BLOB_LOCK])
+    assert blobs == set(blob(conv, n) for n in ['weight', 'bias', 'weightIncr', 'biasIncr'])
+    assert blob(old_conv, 'weightIncr') not in blobs and blob(old_conv, 'biasIncr') not in blobs
+    assert sorted(os.listdir(d)) == [checkpoint.BLOB_DIR, 'test1-1.2']
+    check_loaded(checkpoint.load(new), new_obj, 'none')
+  finally:
+    shutil.rmtree(d)
+
+if __name__ == '__main__':
+  test_round_trip()
+  test_writer()
+  test_collect_blobs()
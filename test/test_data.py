@@ -1,15 +1,275 @@
-from striate import data, util
+from striate import data, fixture, util
+from striate.image_index import ImageIndex
+import itertools
+import numpy as np
+import os
+import shutil
+import tarfile
+import tempfile
+import time
 
 def test_imagenet_loader():
-  df = data.ImageNetDataProvider('/ssd/nn-data/imagenet/', 
-                                 batch_range=range(1000), 
-                                 category_range=range(20),
-                                 batch_size=512)
-  util.log('Index: %s', df.curr_batch_index)
-  util.log('%s', df._get_next_batch()['data'].shape)
-  util.log('Index: %s', df.curr_batch_index) 
-  util.log('%s', df._get_next_batch()['data'].shape)
-  util.log('Index: %s', df.curr_batch_index) 
+  data_dir = tempfile.mkdtemp()
+  try:
+    fixture.make_imagenet(data_dir, num_categories=4, images_per_category=10,
+                          min_size=200, max_size=400)
+    df = data.ImageNetDataProvider(data_dir,
+                                   batch_range=range(10),
+                                   category_range=range(2),
+                                   batch_size=8)
+    util.log('Index: %s', df.curr_batch_index)
+    batch = df.get_next_batch()
+    util.log('%s', batch.data.shape)
+    assert batch.data.shape == (224 * 224 * 3, len(batch.labels))
+    assert set(batch.labels) <= set([0, 1])
+    util.log('Index: %s', df.curr_batch_index)
+    util.log('%s', df.get_next_batch().data.shape)
+    df.close()
+  finally:
+    shutil.rmtree(data_dir)
+
+def test_cifar_loader():
+  data_dir = tempfile.mkdtemp()
+  try:
+    fixture.make_cifar(data_dir, num_batches=3, images_per_batch=100)
+    df = data.CifarDataProvider(data_dir, batch_range=[1, 2])
+    batch = df.get_next_batch()
+    util.log('%s', batch.data.shape)
+    assert batch.data.shape == (3072, 100)
+    assert abs(batch.data.mean()) < 20
+    df.close()
+  finally:
+    shutil.rmtree(data_dir)
+
+def test_crop_batch():
+  rng = np.random.RandomState(0)
+  images = rng.randint(0, 256, size=(3, 3, 10, 12)).astype(np.uint8)
+  ys, xs = np.array([0, 2, 4]), np.array([5, 0, 3])
+  flips = np.array([False, True, False])
+  expected = []
+  for img, y, x, flip in zip(images, ys, xs, flips):
+    crop = img[:, y:y + 6, x:x + 6]
+    expected.append((crop[:, :, ::-1] if flip else crop).reshape(-1))
+  expected = np.array(expected)
+
+  target = np.zeros((3 * 6 * 6, 3), dtype=np.single)
+  data.crop_batch(images, target, ys, xs, flips, 6)
+  assert (target == expected.T).all()
+
+  target = np.zeros((3, 3 * 6 * 6), dtype=np.uint8)
+  data.crop_batch(images, target, ys, xs, flips, 6, sample_major=True)
+  assert (target == expected).all()
+
+  # several crops of one image
+  target = np.zeros((3 * 6 * 6, 3), dtype=np.single)
+  data.crop_batch(images[:1], target, ys, xs, flips, 6, index=np.zeros(3, dtype=np.int64))
+  crop = images[0][:, 2:8, 0:6]
+  assert (target[:, 1] == crop[:, :, ::-1].reshape(-1)).all()
+
+def test_index_select():
+  # categories of 3, 0 and 2 images
+  index = ImageIndex('.', np.zeros(0, dtype=np.uint8), np.zeros(6, dtype=np.int64),
+                     *ImageIndex._label_arrays([0, 3, 3, 5]))
+  assert list(index.positions) == [0, 1, 2, 0, 1]
+  assert list(index.select()) == range(5)
+  assert list(index.select([2, 0])) == [3, 4, 0, 1, 2]
+  assert list(index.select(batch_range=[1])) == [1, 4]
+  assert list(index.select([0, 1], [2, 7])) == [2]
+  assert list(index.select([])) == []
+
+class SlowCifarDataProvider(data.CifarDataProvider):
+  '''Takes longer over the batches it is asked for first, so several
+  readers finish them out of order.'''
+  def _load_batch(self, epoch, batchnum):
+    time.sleep(0.02 * ((3 - self._num_loads.next()) % 4))
+    return data.CifarDataProvider._load_batch(self, epoch, batchnum)
+
+def test_reader_order():
+  data_dir = tempfile.mkdtemp()
+  try:
+    fixture.make_cifar(data_dir, num_batches=4, images_per_batch=10)
+    batches = []
+    for num_readers in [1, 4]:
+      dp = SlowCifarDataProvider(data_dir, batch_range=[1, 2, 3, 4], num_readers=num_readers, seed=7)
+      dp._num_loads = itertools.count()
+      got = []
+      for i in range(8):
+        batch = dp.get_next_batch()
+        got.append((batch.epoch, batch.batchnum, batch.data.copy()))
+      dp.close()
+      batches.append(got)
+    assert [b[:2] for b in batches[0]] == [b[:2] for b in batches[1]]
+    assert all((a[2] == b[2]).all() for a, b in zip(*batches))
+  finally:
+    shutil.rmtree(data_dir)
+
+def make_tars(data_dir):
+  '''Pack every nSYNID directory of an ImageNet fixture into nSYNID.tar.'''
+  for d in sorted(os.listdir(data_dir)):
+    if d.startswith('n') and os.path.isdir(os.path.join(data_dir, d)):
+      with tarfile.open(os.path.join(data_dir, d + '.tar'), 'w') as tar:
+        for f in sorted(os.listdir(os.path.join(data_dir, d))):
+          tar.add(os.path.join(data_dir, d, f), arcname=os.path.join(d, f))
+
+def check_shards(shards, total):
+  '''The ranks' shards are equal, disjoint, and leave out fewer items than
+  there are ranks.'''
+  sizes = set(len(shard) for shard in shards)
+  assert len(sizes) == 1, sizes
+  union = set()
+  for shard in shards:
+    assert not union & set(shard)
+    union |= set(shard)
+  assert total - len(shards) < len(union) <= total
+
+def test_sharding():
+  data_dir = tempfile.mkdtemp()
+  cifar_dir = tempfile.mkdtemp()
+  try:
+    fixture.make_imagenet(data_dir, num_categories=3, images_per_category=7,
+                          min_size=200, max_size=300)
+    make_tars(data_dir)
+    fixture.make_cifar(cifar_dir, num_batches=7, images_per_batch=10)
+    world_size = 3
+
+    def shards(make, items):
+      result = []
+      for rank in range(world_size):
+        dp = make(rank=rank, world_size=world_size)
+        result.append(list(items(dp)))
+        dp.close()
+      return result
+
+    check_shards(shards(lambda **kw: data.ImageNetDataProvider(data_dir, range(7), batch_size=4, **kw),
+                        lambda dp: dp.images[np.concatenate(dp.batches)]), 21)
+    check_shards(shards(lambda **kw: data.TarImageNetDataProvider(data_dir, range(7), batch_size=4, **kw),
+                        lambda dp: dp.images[dp._epoch_order(1)]), 21)
+    check_shards(shards(lambda **kw: data.CifarDataProvider(cifar_dir, range(1, 8), **kw),
+                        lambda dp: dp.batch_range), 7)
+    check_shards(shards(lambda **kw: data.CifarMemoryDataProvider(cifar_dir, range(1, 8),
+                                                                  images_per_batch=8, **kw),
+                        lambda dp: dp._epoch_order(1)), 70)
+  finally:
+    shutil.rmtree(data_dir)
+    shutil.rmtree(cifar_dir)
+
+def test_tar_epochs():
+  data_dir = tempfile.mkdtemp()
+  try:
+    fixture.make_imagenet(data_dir, num_categories=3, images_per_category=5,
+                          min_size=200, max_size=300)
+    make_tars(data_dir)
+
+    def epoch_orders(seed):
+      dp = data.TarImageNetDataProvider(data_dir, range(5), batch_size=4, shuffle_size=4, seed=seed)
+      orders = {}
+      # the first epoch starts at its second batch, so look at the next two
+      while len(orders.get(3, [])) < len(dp.batch_range):
+        batch = dp.get_next_batch()
+        images = dp._batch_images(batch.epoch, batch.batchnum)
+        assert (batch.labels == dp._index.labels[images]).all()
+        orders.setdefault(batch.epoch, []).append(images)
+      dp.close()
+      orders = [list(np.concatenate(orders[epoch])) for epoch in [2, 3]]
+      for order in orders:
+        # every image of the epoch exactly once
+        assert sorted(order) == sorted(dp.images)
+      return orders
+
+    first = epoch_orders(3)
+    assert first[0] != first[1]
+    assert epoch_orders(3) == first
+    assert epoch_orders(4) != first
+  finally:
+    shutil.rmtree(data_dir)
+
+def test_cifar_memory_layouts():
+  data_dir = tempfile.mkdtemp()
+  try:
+    fixture.make_cifar(data_dir, num_batches=2, images_per_batch=50)
+    for raw_pixels, sample_major in itertools.product([False, True], repeat=2):
+      dp = data.CifarMemoryDataProvider(data_dir, [1, 2], images_per_batch=32, seed=1,
+                                        raw_pixels=raw_pixels, sample_major=sample_major)
+      for i in range(len(dp.batch_range) + 1):
+        batch = dp.get_next_batch()
+        index = np.array_split(dp._epoch_order(batch.epoch), len(dp.batch_range))[batch.batchnum]
+        rows = np.asarray(dp._data[index])
+        expected = rows if sample_major else rows.T
+        if raw_pixels:
+          assert batch.data.dtype == np.uint8
+          assert (batch.mean == dp.data_mean).all()
+        else:
+          assert batch.data.dtype == np.single
+          expected = expected - (dp.data_mean.T if sample_major else dp.data_mean)
+        assert (batch.data == expected).all()
+        assert (batch.labels == dp._labels[index]).all()
+      dp.close()
+  finally:
+    shutil.rmtree(data_dir)
+
+def test_augment_seeded():
+  data_dir = tempfile.mkdtemp()
+  try:
+    fixture.make_imagenet(data_dir, num_categories=2, images_per_category=6,
+                          min_size=200, max_size=300)
+
+    def batches(seed, num_workers, num_readers):
+      dp = data.ImageNetDataProvider(data_dir, range(6), batch_size=4, seed=seed,
+                                     augment='crop:224,flip,lighting,contrast',
+                                     num_workers=num_workers, num_readers=num_readers)
+      got = []
+      for i in range(4):
+        batch = dp.get_next_batch()
+        got.append((batch.epoch, batch.batchnum, batch.data.copy()))
+      dp.close()
+      return got
+
+    def same(a, b):
+      return all(x[:2] == y[:2] and (x[2] == y[2]).all() for x, y in zip(a, b))
+
+    # decoding in worker processes and on several readers draws the same
+    # augmentation as decoding on one reader thread
+    first = batches(5, 0, 1)
+    assert same(batches(5, 2, 1), first)
+    assert same(batches(5, 2, 2), first)
+    assert not same(batches(6, 0, 1), first)
+  finally:
+    shutil.rmtree(data_dir)
+
+def test_store_stays_warm():
+  data_dir = tempfile.mkdtemp()
+  try:
+    fixture.make_imagenet(data_dir, num_categories=2, images_per_category=6,
+                          min_size=200, max_size=300)
+    store = data.SampleStore(data_dir, num_workers=2, cache_mem=64 << 20)
+
+    def read_epochs(category_range):
+      dp = data.ImageNetDataProvider(data_dir, range(6), category_range, batch_size=4, store=store)
+      for i in range(2 * len(dp.batch_range)):
+        dp.get_next_batch()
+      dp.close()
+
+    read_epochs(range(2))
+    cache = store.cache
+    misses = cache.misses
+    assert misses == 12
+    # a provider built for the next stage reuses the workers and the images
+    pool = store.pool
+    read_epochs([1])
+    assert store.pool is pool and store.cache is cache
+    assert cache.misses == misses and cache.hits > 0
+    store.close()
+  finally:
+    shutil.rmtree(data_dir)
 
 if __name__ == '__main__':
   test_imagenet_loader()
+  test_cifar_loader()
+  test_crop_batch()
+  test_index_select()
+  test_reader_order()
+  test_sharding()
+  test_tar_epochs()
+  test_cifar_memory_layouts()
+  test_augment_seeded()
+  test_store_stays_warm()
@@ -0,0 +1,53 @@
+from striate import data, fixture, shard, util
+from striate.image_index import ImageIndex
+import numpy as np
+import os
+import shutil
+import tempfile
+
+def test_shard_round_trip():
+  data_dir = tempfile.mkdtemp()
+  shard_dir = os.path.join(data_dir, 'shards')
+  try:
+    fixture.make_imagenet(data_dir, num_categories=3, images_per_category=5,
+                          min_size=100, max_size=300, img_size=64)
+    # a short last shard, and chunks that straddle shards
+    shard.convert(data_dir, shard_dir, img_size=64, records_per_shard=4, chunk_size=3)
+
+    index = ImageIndex.open(data_dir, util.load(os.path.join(data_dir, 'batches.meta')))
+    reader = shard.ShardReader(shard_dir)
+    assert reader.num_records == index.num_images == 15
+    assert len(reader.shards) == 4
+    assert (reader.labels == index.labels).all()
+    assert (reader.positions == index.positions).all()
+
+    records = np.array([14, 0, 5, 7])
+    expected = data._decode_jpegs(index.paths(records), 64)
+    assert (reader.gather(records) == expected).all()
+    for (path, offset, size), r in zip(reader.extents(records), records):
+      with open(path, 'rb') as f:
+        f.seek(offset)
+        assert f.read(size) == expected[list(records).index(r)].tostring()
+  finally:
+    shutil.rmtree(data_dir)
+
+def test_sharded_provider():
+  data_dir = tempfile.mkdtemp()
+  shard_dir = os.path.join(data_dir, 'shards')
+  try:
+    fixture.make_imagenet(data_dir, num_categories=2, images_per_category=5,
+                          min_size=200, max_size=300)
+    shard.convert(data_dir, shard_dir)
+    # there is nothing to decode or cache, so neither is set up
+    dp = data.ShardedImageNetDataProvider(shard_dir, batch_range=range(5), batch_size=4,
+                                          num_workers=2, cache_mem=1 << 20)
+    assert dp._pool is None and dp._cache is None
+    batch = dp.get_next_batch()
+    assert batch.data.shape == (224 * 224 * 3, len(batch.labels))
+    dp.close()
+  finally:
+    shutil.rmtree(data_dir)
+
+if __name__ == '__main__':
+  test_shard_round_trip()
+  test_sharded_provider()
@@ -0,0 +1,19 @@
+from striate import util
+import numpy as np
+
+def test_blocked_transpose():
+  rng = np.random.RandomState(0)
+  src = rng.randint(0, 256, size=(37, 1000)).astype(np.uint8)
+  mean = rng.rand(1000, 1).astype(np.single)
+  # blocks that do not divide the columns, and one wider than all of them
+  for block in [1, 7, 512, 4096]:
+    dst = np.empty((1000, 37), dtype=np.uint8)
+    assert util.blocked_transpose(src, dst, block=block) is dst
+    assert (dst == np.ascontiguousarray(src.T)).all()
+
+    dst = np.empty((1000, 37), dtype=np.single)
+    util.blocked_transpose(src, dst, mean, block=block)
+    assert np.allclose(dst, np.ascontiguousarray(src.T) - mean)
+
+if __name__ == '__main__':
+  test_blocked_transpose()